@@ -1,136 +1,1619 @@
 import streamlit as st
 import google.generativeai as genai
+from google.api_core import exceptions as google_exceptions
 from dotenv import load_dotenv
 import os
 import json
 import time
+import threading
+import hashlib
+import re
+import random
+import sqlite3
+import uuid
+import datetime
+import string
+import textwrap
+from collections import OrderedDict, deque
+from enum import Enum
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+
+load_dotenv()
+
+# Model used for all requests; override with GEMINI_MODEL in .env
+MODEL_NAME = os.getenv('GEMINI_MODEL', 'gemini-2.0-flash')
+# Seconds a successful health check stays valid for the whole process
+HEALTH_CHECK_INTERVAL = 300
+# Seconds the health check may take; it holds the client lock, so a hung call would block every new session
+HEALTH_CHECK_TIMEOUT = float(os.getenv('HEALTH_CHECK_TIMEOUT', 5))
+
+# Model tiers: a small, fast model for preference extraction and a stronger one for
+# itineraries. A call that times out on one tier falls back to the other
+EXTRACTION_MODEL = os.getenv('EXTRACTION_MODEL', 'gemini-2.0-flash-lite')
+ITINERARY_MODEL = os.getenv('ITINERARY_MODEL', MODEL_NAME)
+EXTRACTION_MAX_TOKENS = int(os.getenv('EXTRACTION_MAX_TOKENS', 256))
+EXTRACTION_TEMPERATURE = float(os.getenv('EXTRACTION_TEMPERATURE', 0.1))
+ITINERARY_MAX_TOKENS = int(os.getenv('ITINERARY_MAX_TOKENS', 8192))
+ITINERARY_TEMPERATURE = float(os.getenv('ITINERARY_TEMPERATURE', 0.7))
+# Seconds each request may take in total, including retries, backoff and the fallback tier
+EXTRACTION_TIMEOUT = float(os.getenv('EXTRACTION_TIMEOUT', 3))
+ITINERARY_TIMEOUT = float(os.getenv('ITINERARY_TIMEOUT', 60))
+
+# Put task system instructions in an explicit context cache where the API accepts them;
+# instructions below the API's minimum cache size fall back to a plain system_instruction
+CONTEXT_CACHE = os.getenv('CONTEXT_CACHE', 'false').lower() == 'true'
+CONTEXT_CACHE_TTL = int(os.getenv('CONTEXT_CACHE_TTL', 3600))  # Seconds
+
+# Factory used to build model clients; swap for a fake model in local tests
+model_factory = genai.GenerativeModel
+
+
+class ModelClient:
+    """Shared Gemini model with a lazy, time-based health check"""
+
+    def __init__(self, model_name, api_key):
+        genai.configure(api_key=api_key)
+        self.model_name = model_name
+        self.model = model_factory(model_name)
+        self.healthy = False
+        self.last_check = 0.0
+        self.task_models = {}  # task -> (model, expires_at)
+        self.lock = threading.Lock()
+        self.task_lock = threading.Lock()
+
+    def check_health(self):
+        """Send a test prompt unless a recent check already succeeded"""
+        with self.lock:
+            if self.healthy and time.monotonic() - self.last_check < HEALTH_CHECK_INTERVAL:
+                return True
+            try:
+                response = self.model.generate_content("Hi", request_options={'timeout': HEALTH_CHECK_TIMEOUT})
+                self.healthy = bool(response and response.text)
+            except Exception as e:
+                print(f"Gemini health check failed: {str(e)}")
+                self.healthy = False
+            self.last_check = time.monotonic()
+            return self.healthy
+
+    def mark_unhealthy(self):
+        """Force a new health check on the next initialization"""
+        self.healthy = False
+
+    def model_for(self, task):
+        """Return the model carrying a task's system instruction, built once per process"""
+        instruction = SYSTEM_INSTRUCTIONS.get(task)
+        if instruction is None:
+            return self.model
+        with self.task_lock:
+            model, expires_at = self.task_models.get(task, (None, 0.0))
+            if model is None or time.monotonic() >= expires_at:
+                model, expires_at = self.build_task_model(task, instruction)
+                self.task_models[task] = (model, expires_at)
+            return model
+
+    def build_task_model(self, task, instruction):
+        """Return (model, expires_at), using an explicit context cache when enabled and accepted"""
+        if CONTEXT_CACHE:
+            try:
+                cache = genai.caching.CachedContent.create(
+                    model=self.model_name, display_name=f"travel-planner-{task}",
+                    system_instruction=instruction, ttl=datetime.timedelta(seconds=CONTEXT_CACHE_TTL),
+                )
+                # Rebuild a little before the cache expires upstream
+                return genai.GenerativeModel.from_cached_content(cache), time.monotonic() + CONTEXT_CACHE_TTL * 0.9
+            except Exception as e:
+                print(f"Context cache unavailable for {task}, using system_instruction: {str(e)}")
+        return model_factory(self.model_name, system_instruction=instruction), float('inf')
+
+
+@st.cache_resource(show_spinner=False)
+def get_model_client(model_name, api_key):
+    """Return the process-wide client for a model name and API key"""
+    return ModelClient(model_name, api_key)
+
+
+class TaskRoute:
+    """Model tier, generation settings and time budget for one kind of request"""
+
+    def __init__(self, tier, max_output_tokens=None, temperature=None, timeout=None):
+        self.tier = tier
+        self.max_output_tokens = max_output_tokens
+        self.temperature = temperature
+        self.timeout = timeout
+
+    def model_name(self, fallback=False):
+        tier = self.tier
+        if fallback:
+            tier = 'strong' if tier == 'fast' else 'fast'
+        return MODEL_TIERS[tier]
+
+    def generation_config(self, extra=None):
+        """The route's output cap and temperature plus any per-call settings"""
+        config = {}
+        if self.max_output_tokens is not None:
+            config['max_output_tokens'] = self.max_output_tokens
+        if self.temperature is not None:
+            config['temperature'] = self.temperature
+        config.update(extra or {})
+        return config or None
+
+
+MODEL_TIERS = {'fast': EXTRACTION_MODEL, 'strong': ITINERARY_MODEL}
+TASK_ROUTES = {
+    'extract': TaskRoute('fast', EXTRACTION_MAX_TOKENS, EXTRACTION_TEMPERATURE, EXTRACTION_TIMEOUT),
+    'turn': TaskRoute('fast', EXTRACTION_MAX_TOKENS, EXTRACTION_TEMPERATURE, EXTRACTION_TIMEOUT),
+    'itinerary': TaskRoute('strong', ITINERARY_MAX_TOKENS, ITINERARY_TEMPERATURE, ITINERARY_TIMEOUT),
+    'itinerary_section': TaskRoute('strong', ITINERARY_MAX_TOKENS, ITINERARY_TEMPERATURE, ITINERARY_TIMEOUT),
+}
+DEFAULT_ROUTE = TaskRoute('strong')
+
+
+class ModelRoute:
+    """A task's resolved model, timeout fallback, generation config and time budget
+
+    Safe to hand to worker threads. Calls without an explicit deadline get a
+    fresh one from the task's budget.
+    """
+
+    def __init__(self, task, model, fallback=None, generation_config=None, timeout=None):
+        self.task = task
+        self.model = model
+        self.fallback = fallback
+        self.generation_config = generation_config
+        self.timeout = timeout
+
+    def deadline(self):
+        return Deadline(self.timeout)
+
+    def generate(self, engine, prompt, use_cache=True, deadline=None):
+        return engine.generate(
+            self.model, prompt, use_cache, self.generation_config, caller=self.task, fallback=self.fallback,
+            deadline=deadline or self.deadline(),
+        )
+
+    def stream(self, engine, prompt, use_cache=True, deadline=None):
+        return engine.stream(
+            self.model, prompt, use_cache, caller=self.task, fallback=self.fallback,
+            generation_config=self.generation_config, deadline=deadline or self.deadline(),
+        )
+
+
+def get_task_model(task, fallback=False):
+    """Return the shared model for a task, e.g. 'extract' or 'itinerary', on its own or its fallback tier"""
+    model_name = TASK_ROUTES.get(task, DEFAULT_ROUTE).model_name(fallback)
+    return get_model_client(model_name, os.getenv('GOOGLE_API_KEY')).model_for(task)
+
+
+def resolve_route(task, generation_config=None):
+    """Pick the models and generation config for a task in the script thread"""
+    route = TASK_ROUTES.get(task, DEFAULT_ROUTE)
+    fallback = None
+    if route.model_name(fallback=True) != route.model_name():
+        fallback = get_task_model(task, fallback=True)
+    return ModelRoute(
+        task, get_task_model(task), fallback, route.generation_config(generation_config), route.timeout
+    )
+
+
+def task_deadline(task):
+    """A new deadline for one request of a task, from its time budget"""
+    return Deadline(TASK_ROUTES.get(task, DEFAULT_ROUTE).timeout)
+
 
 def initialize_gemini():
-    """Initialize and test Gemini API connection"""
+    """Get the shared Gemini model, testing the connection only when needed"""
     try:
-        # Load and configure API key
-        load_dotenv()
         api_key = os.getenv('GOOGLE_API_KEY')
         if not api_key:
             st.error("API key not found. Please check your .env file.")
             return False
 
-        genai.configure(api_key=api_key)
-        
-        # Use Gemini 2.0 Flash model (free tier)
-        model = genai.GenerativeModel('gemini-2.0-flash')
-        
-        # Test the connection with a simple prompt
-        try:
-            response = model.generate_content("Hi")
-            if response and response.text:
-                st.success("Successfully connected to Gemini API!")
-                return model
-            else:
-                st.error("Could not get a valid response from Gemini API.")
-                return False
-        except Exception as api_error:
-            st.error(f"Error testing Gemini API connection: {str(api_error)}")
+        client = get_model_client(MODEL_NAME, api_key)
+        if not client.check_health():
+            st.error("Could not get a valid response from Gemini API.")
             return False
-            
+        return client.model
+
     except Exception as e:
         st.error(f"Error configuring Gemini API: {str(e)}")
         return False
 
+# Response cache settings; CACHE_BACKEND is 'memory' or 'sqlite'
+CACHE_BACKEND = os.getenv('CACHE_BACKEND', 'memory')
+CACHE_PATH = os.getenv('CACHE_PATH', 'response_cache.db')
+CACHE_TTL = int(os.getenv('CACHE_TTL', 3600))  # Seconds
+CACHE_MAX_ENTRIES = int(os.getenv('CACHE_MAX_ENTRIES', 256))
+
+
+def make_cache_key(model_name, prompt, generation_config=None, task=None):
+    """Hash the model, task (which selects the system instruction), whitespace-normalized prompt and generation config"""
+    normalized = ' '.join(prompt.split())
+    payload = json.dumps([model_name, task, normalized, generation_config or {}], sort_keys=True, default=str)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+
+class MemoryCache:
+    """In-process LRU response cache with per-entry TTL"""
+
+    def __init__(self, max_entries=CACHE_MAX_ENTRIES, ttl=CACHE_TTL):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or entry[1] < time.time():
+                self.entries.pop(key, None)
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def set(self, key, value, ttl=None):
+        with self.lock:
+            self.entries[key] = (value, time.time() + (ttl or self.ttl))
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def stats(self):
+        return {'backend': 'memory', 'entries': len(self.entries), 'hits': self.hits, 'misses': self.misses}
+
+
+class SQLiteCache:
+    """On-disk response cache shared by every worker using the same file"""
+
+    def __init__(self, path=CACHE_PATH, max_entries=CACHE_MAX_ENTRIES, ttl=CACHE_TTL):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS responses "
+            "(key TEXT PRIMARY KEY, value TEXT, expires REAL, accessed REAL)"
+        )
+        self.conn.commit()
+
+    def get(self, key):
+        now = time.time()
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT value FROM responses WHERE key = ? AND expires >= ?", (key, now)
+            ).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.conn.execute("UPDATE responses SET accessed = ? WHERE key = ?", (now, key))
+            self.conn.commit()
+            self.hits += 1
+            return row[0]
+
+    def set(self, key, value, ttl=None):
+        now = time.time()
+        with self.lock:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?)",
+                (key, value, now + (ttl or self.ttl), now)
+            )
+            # Drop expired rows, then the least recently used beyond the size limit
+            self.conn.execute("DELETE FROM responses WHERE expires < ?", (now,))
+            self.conn.execute(
+                "DELETE FROM responses WHERE key NOT IN "
+                "(SELECT key FROM responses ORDER BY accessed DESC LIMIT ?)",
+                (self.max_entries,)
+            )
+            self.conn.commit()
+
+    def stats(self):
+        with self.lock:
+            entries = self.conn.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+        return {'backend': 'sqlite', 'entries': entries, 'hits': self.hits, 'misses': self.misses}
+
+
+@st.cache_resource(show_spinner=False)
+def get_response_cache():
+    """Return the process-wide response cache for the configured backend"""
+    if CACHE_BACKEND == 'sqlite':
+        return SQLiteCache()
+    return MemoryCache()
+
+# Fields extracted from user messages, with the JSON type the model should return
+PREFERENCE_FIELDS = {
+    'budget': 'string',
+    'duration': 'integer',
+    'destination': 'string',
+    'starting_location': 'string',
+    'purpose': 'string',
+    'preferences': 'array',
+    'dietary_restrictions': 'array',
+    'mobility_concerns': 'string',
+    'accommodation_preferences': 'string',
+}
+# Fields required before an itinerary can be generated
+ESSENTIAL_FIELDS = ['budget', 'duration', 'destination', 'starting_location']
+FIELD_BITS = {field: 1 << i for i, field in enumerate(PREFERENCE_FIELDS)}
+ESSENTIAL_MASK = sum(FIELD_BITS[field] for field in ESSENTIAL_FIELDS)
+
+BUDGET_LEVELS = {
+    'budget-friendly': ['budget-friendly', 'budget', 'cheap', 'affordable', 'economical', 'backpacking', 'low'],
+    'mid-range': ['mid-range', 'midrange', 'mid range', 'moderate', 'medium', 'mid', 'standard'],
+    'luxury': ['luxury', 'luxurious', 'lavish', 'premium', 'high-end', 'splurge', '5-star', 'five star'],
+}
+CURRENCY_CODES = {
+    '$': 'USD', 'usd': 'USD', 'dollar': 'USD', 'dollars': 'USD',
+    '€': 'EUR', 'eur': 'EUR', 'euro': 'EUR', 'euros': 'EUR',
+    '£': 'GBP', 'gbp': 'GBP', 'pound': 'GBP', 'pounds': 'GBP',
+    '₹': 'INR', 'inr': 'INR', 'rupee': 'INR', 'rupees': 'INR', 'rs': 'INR',
+}
+# An amount with an optional word before it, currency symbol, 'k' and word after it. A number
+# directly followed by a hyphen is a compound such as "5-star" or "10-day", not an amount
+BUDGET_AMOUNT_PATTERN = re.compile(
+    r'(?:\b(?P<before>[a-z]+)\s+)?(?P<symbol>[$€£₹])?\s*(?P<number>\d[\d,]*(?:\.\d+)?)(?![\d,]|\.\d|-)'
+    r'\s*(?P<k>k\b)?\s*(?P<after>[a-z]+)?'
+)
+# Below this, a number with no currency next to a level keyword is a count, as in "luxury, for 2"
+MIN_BARE_AMOUNT = 100
+# Level keywords for parse_budget; the bare word 'budget' is left out, since
+# "luxury budget" or "high budget" use it as a noun rather than a level
+BUDGET_LEVEL_WORDS = {word: level for level, words in BUDGET_LEVELS.items() for word in words if word != 'budget'}
+BUDGET_LEVEL_PATTERN = re.compile(
+    r'\b(' + '|'.join(sorted((re.escape(w) for w in BUDGET_LEVEL_WORDS), key=len, reverse=True)) + r')\b'
+)
+
+
+class BudgetLevel(str, Enum):
+    BUDGET_FRIENDLY = 'budget-friendly'
+    MID_RANGE = 'mid-range'
+    LUXURY = 'luxury'
+
+
+def parse_budget(value):
+    """Split a budget answer into (level, amount, currency); unknown parts are None"""
+    text = str(value).lower().strip()
+    level = None
+    # Leftmost, then longest keyword wins, as in the local extractor
+    match = BUDGET_LEVEL_PATTERN.search(text)
+    if match:
+        level = BudgetLevel(BUDGET_LEVEL_WORDS[match.group(1)])
+    elif text == 'budget':
+        level = BudgetLevel.BUDGET_FRIENDLY
+    amount = currency = None
+    match = BUDGET_AMOUNT_PATTERN.search(text)
+    if match:
+        before, after = match.group('before'), match.group('after')
+        leading = match.group('symbol') or (before if before in CURRENCY_CODES else None)
+        # Without a leading currency a trailing word must be a currency, so "3 lakhs" or "5 days" are
+        # not amounts; with one, it is just the rest of the sentence, as in "$3000 for two"
+        if leading or after is None or after in CURRENCY_CODES:
+            amount = float(match.group('number').replace(',', '')) * (1000 if match.group('k') else 1)
+            currency = CURRENCY_CODES.get(leading or after or '')
+            if currency is None and level is not None and not match.group('k') and amount < MIN_BARE_AMOUNT:
+                amount = None
+    return level, amount, currency
+
+
+class TravelPreferences:
+    """Typed trip preferences with a bitmask of missing fields for O(1) readiness checks
+
+    Supports dict-style access (prefs['budget'], get, items) so prompt
+    builders can treat it like the plain dict it replaces.
+    """
+
+    __slots__ = (
+        'budget_level', 'budget_amount', 'budget_currency', 'budget_note', 'duration', 'destination',
+        'starting_location', 'purpose', 'preferences', 'dietary_restrictions', 'mobility_concerns',
+        'accommodation_preferences', 'missing',
+    )
+
+    def __init__(self):
+        self.budget_level = None
+        self.budget_amount = None
+        self.budget_currency = None
+        self.budget_note = None
+        self.duration = None
+        self.destination = None
+        self.starting_location = None
+        self.purpose = None
+        self.preferences = []
+        self.dietary_restrictions = []
+        self.mobility_concerns = None
+        self.accommodation_preferences = None
+        # Empty lists count as answered, as they did in the original dict
+        self.missing = sum(bit for field, bit in FIELD_BITS.items() if PREFERENCE_FIELDS[field] != 'array')
+
+    @property
+    def budget(self):
+        """Budget as shown to the user and the model, e.g. 'luxury (2,000 USD)'"""
+        amount = None
+        if self.budget_amount is not None:
+            amount = f"{self.budget_amount:,.0f} {self.budget_currency or ''}".strip()
+        if self.budget_level and amount:
+            return f"{self.budget_level.value} ({amount})"
+        if self.budget_level or amount:
+            return self.budget_level.value if self.budget_level else amount
+        return self.budget_note
+
+    def set(self, field, value):
+        """Normalize and store a field value, keeping the missing-field mask in sync"""
+        if field not in FIELD_BITS:
+            raise KeyError(field)
+        if field == 'budget':
+            self.budget_level, self.budget_amount, self.budget_currency = (
+                parse_budget(value) if value is not None else (None, None, None)
+            )
+            # Keep answers we cannot parse, such as "3 lakhs", as free text
+            parsed = self.budget_level or self.budget_amount is not None
+            self.budget_note = None if parsed or value is None else str(value).strip()
+        elif PREFERENCE_FIELDS[field] == 'integer':
+            value = int(re.search(r'\d+', str(value)).group()) if value is not None else None
+            setattr(self, field, value)
+        elif PREFERENCE_FIELDS[field] == 'array':
+            setattr(self, field, [] if value is None else list(value) if isinstance(value, list) else [value])
+        else:
+            setattr(self, field, None if value is None else str(value).strip())
+
+        if self.get(field) is None:
+            self.missing |= FIELD_BITS[field]
+        else:
+            self.missing &= ~FIELD_BITS[field]
+
+    def is_missing(self, field):
+        return bool(self.missing & FIELD_BITS[field])
+
+    def is_ready(self):
+        """Whether every field needed for an itinerary is known"""
+        return not self.missing & ESSENTIAL_MASK
+
+    def missing_essentials(self):
+        return [field for field in ESSENTIAL_FIELDS if self.missing & FIELD_BITS[field]]
+
+    def __getitem__(self, field):
+        if field not in FIELD_BITS:
+            raise KeyError(field)
+        return getattr(self, field)
+
+    __setitem__ = set
+
+    def __contains__(self, field):
+        return field in FIELD_BITS
+
+    def get(self, field, default=None):
+        value = self[field] if field in FIELD_BITS else None
+        return default if value is None else value
+
+    def keys(self):
+        return list(PREFERENCE_FIELDS)
+
+    def items(self):
+        return [(field, self[field]) for field in PREFERENCE_FIELDS]
+
+    def values(self):
+        return [self[field] for field in PREFERENCE_FIELDS]
+
+    def to_dict(self):
+        return dict(self.items())
+
+    def to_json(self):
+        """Compact, key-sorted serialization used for persistence and cache keys"""
+        return json.dumps(self.to_dict(), sort_keys=True, separators=(',', ':'), ensure_ascii=False)
+
+    @classmethod
+    def from_dict(cls, data):
+        prefs = cls()
+        for field, value in data.items():
+            if field in FIELD_BITS:
+                prefs.set(field, value)
+        return prefs
+
+    def copy(self):
+        return TravelPreferences.from_dict(self.to_dict())
+
+    def __repr__(self):
+        return f"TravelPreferences({self.to_json()})"
+
+
 # Initialize session state
 if 'chat_history' not in st.session_state:
     st.session_state.chat_history = []
+if 'history_summary' not in st.session_state:
+    st.session_state.history_summary = ''
 if 'user_preferences' not in st.session_state:
-    st.session_state.user_preferences = {
-        'budget': None,
-        'duration': None,
-        'destination': None,
-        'starting_location': None,
-        'purpose': None,
-        'preferences': [],
-        'dietary_restrictions': [],
-        'mobility_concerns': None,
-        'accommodation_preferences': None
-    }
+    st.session_state.user_preferences = TravelPreferences()
 if 'last_input' not in st.session_state:
     st.session_state.last_input = None
 if 'asked_questions' not in st.session_state:
     st.session_state.asked_questions = set()
+if 'pending_field' not in st.session_state:
+    st.session_state.pending_field = None
+if 'itinerary' not in st.session_state:
+    st.session_state.itinerary = None
+if 'itinerary_job' not in st.session_state:
+    st.session_state.itinerary_job = None
+if 'script_runs' not in st.session_state:
+    st.session_state.script_runs = 0
+if 'turn_runs' not in st.session_state:
+    st.session_state.turn_runs = 0
+if 'turn_count' not in st.session_state:
+    st.session_state.turn_count = 0
+if 'turns_to_itinerary' not in st.session_state:
+    st.session_state.turns_to_itinerary = None
+
+# Retry and circuit breaker settings
+RETRY_MAX_ATTEMPTS = int(os.getenv('RETRY_MAX_ATTEMPTS', 3))
+RETRY_BASE_DELAY = float(os.getenv('RETRY_BASE_DELAY', 0.5))  # Seconds
+RETRY_MAX_DELAY = float(os.getenv('RETRY_MAX_DELAY', 20))  # Seconds
+BREAKER_FAILURE_THRESHOLD = int(os.getenv('BREAKER_FAILURE_THRESHOLD', 5))
+BREAKER_RESET_TIMEOUT = float(os.getenv('BREAKER_RESET_TIMEOUT', 30))  # Seconds
+
+# Errors that will fail the same way on every attempt
+FATAL_ERRORS = (
+    google_exceptions.BadRequest,
+    google_exceptions.Unauthorized,
+    google_exceptions.Forbidden,
+    google_exceptions.NotFound,
+    google_exceptions.MethodNotAllowed,
+    google_exceptions.FailedPrecondition,
+    ValueError,  # Raised by response.text when the prompt was blocked
+)
+
+
+TIMEOUT_ERRORS = (google_exceptions.DeadlineExceeded, TimeoutError, FutureTimeoutError)
+
+
+def is_timeout(error):
+    """Whether an error means the model did not answer in time"""
+    return isinstance(error, TIMEOUT_ERRORS)
+
+
+def is_retryable(error):
+    """Whether an error is worth retrying; unknown errors are assumed transient"""
+    return not isinstance(error, FATAL_ERRORS)
+
+
+def get_retry_after(error):
+    """Return the server's retry-after hint in seconds, if it sent one"""
+    hint = getattr(error, 'retry_after', None)
+    if hint is not None:
+        return float(hint)
+    for detail in getattr(error, 'details', None) or []:
+        delay = getattr(detail, 'retry_delay', None)
+        if delay is not None:
+            return delay.seconds + delay.nanos / 1e9
+    headers = getattr(getattr(error, 'response', None), 'headers', None) or {}
+    try:
+        return float(headers.get('Retry-After'))
+    except (TypeError, ValueError):
+        return None
+
+
+class RetryPolicy:
+    """Exponential backoff with full jitter, honoring server retry-after hints"""
+
+    def __init__(self, max_attempts=RETRY_MAX_ATTEMPTS, base_delay=RETRY_BASE_DELAY,
+                 max_delay=RETRY_MAX_DELAY, sleep=time.sleep):
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.sleep = sleep
+
+    def backoff(self, attempt, error=None):
+        """Seconds to wait after the given zero-based attempt failed"""
+        delay = random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+        hint = get_retry_after(error) if error is not None else None
+        if hint is not None:
+            delay = max(delay, min(hint, self.max_delay))
+        return delay
+
+
+class DeadlineExpired(Exception):
+    """Raised when a request's time budget is spent before it could finish"""
+
+
+class StreamInterrupted(Exception):
+    """Raised when a stream fails after part of the answer was already yielded"""
+
+
+class Deadline:
+    """Time budget shared by every attempt, backoff and fallback of one request"""
+
+    def __init__(self, seconds=None):
+        self.seconds = seconds
+        self.expires_at = None if seconds is None else time.monotonic() + seconds
+
+    def remaining(self):
+        """Seconds left, or None for no limit"""
+        if self.expires_at is None:
+            return None
+        return max(0.0, self.expires_at - time.monotonic())
+
+    def expired(self):
+        return self.expires_at is not None and time.monotonic() >= self.expires_at
+
+    def check(self):
+        if self.expired():
+            raise DeadlineExpired(f"Request exceeded its {self.seconds:g}s budget")
 
-def get_ai_response(prompt):
-    """Get response from Gemini API"""
+
+class CircuitOpenError(Exception):
+    """Raised when the circuit breaker is rejecting requests"""
+
+
+class CircuitBreaker:
+    """Fails fast after repeated upstream failures until a probe request succeeds"""
+
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    def __init__(self, failure_threshold=BREAKER_FAILURE_THRESHOLD, reset_timeout=BREAKER_RESET_TIMEOUT):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self.probing = False
+        self.rejected = 0
+        self.lock = threading.Lock()
+
+    def allow_request(self):
+        """Whether a request may go upstream; half-open lets a single probe through"""
+        return self.admit() is not None
+
+    def admit(self):
+        """Admit a request: CLOSED, HALF_OPEN for the single probe, or None when rejected"""
+        with self.lock:
+            if self.state == self.OPEN and time.monotonic() - self.opened_at >= self.reset_timeout:
+                self.state = self.HALF_OPEN
+                self.probing = False
+            if self.state == self.CLOSED or (self.state == self.HALF_OPEN and not self.probing):
+                self.probing = self.state == self.HALF_OPEN
+                return self.state
+            self.rejected += 1
+            return None
+
+    def release_probe(self):
+        """End a probe that finished without a verdict, so the next request can probe instead"""
+        with self.lock:
+            if self.state == self.HALF_OPEN:
+                self.probing = False
+
+    def record_success(self):
+        with self.lock:
+            self.state = self.CLOSED
+            self.failures = 0
+            self.probing = False
+
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.state == self.HALF_OPEN or self.failures >= self.failure_threshold:
+                self.state = self.OPEN
+                self.opened_at = time.monotonic()
+            self.probing = False
+
+    def snapshot(self):
+        """Current breaker state for monitoring"""
+        with self.lock:
+            return {'state': self.state, 'failures': self.failures, 'rejected': self.rejected}
+
+
+# Client-side rate limits; defaults match the Gemini 2.0 Flash free tier
+RATE_LIMIT_RPM = int(os.getenv('RATE_LIMIT_RPM', 15))
+RATE_LIMIT_TPM = int(os.getenv('RATE_LIMIT_TPM', 1000000))
+RATE_LIMIT_TIMEOUT = float(os.getenv('RATE_LIMIT_TIMEOUT', 30))  # Seconds a call may queue
+# Set to a file path to share one budget between all workers on a host
+RATE_LIMIT_STATE = os.getenv('RATE_LIMIT_STATE')
+
+
+def estimate_tokens(text):
+    """Rough token count (about four characters per token)"""
+    return max(1, len(text) // 4)
+
+
+class RateLimitExceeded(Exception):
+    """Raised when a call could not get rate limit budget before its timeout"""
+
+
+class MemoryBucketStore:
+    """Keeps token bucket state in this process"""
+
+    def __init__(self):
+        self.state = None
+        self.lock = threading.Lock()
+
+    def transact(self, update):
+        """Apply update(state) -> (new_state, result) atomically"""
+        with self.lock:
+            self.state, result = update(self.state)
+            return result
+
+
+class FileBucketStore:
+    """Keeps token bucket state in a locked file shared by processes on one host"""
+
+    def __init__(self, path):
+        self.path = path
+
+    def transact(self, update):
+        import fcntl  # POSIX only; the memory store works everywhere
+        with open(self.path, 'a+') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                f.seek(0)
+                raw = f.read()
+                state, result = update(json.loads(raw) if raw else None)
+                f.seek(0)
+                f.truncate()
+                f.write(json.dumps(state))
+                f.flush()
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+        return result
+
+
+class TokenBucketLimiter:
+    """Paces calls against requests-per-minute and tokens-per-minute budgets"""
+
+    def __init__(self, rpm=RATE_LIMIT_RPM, tpm=RATE_LIMIT_TPM, store=None, timeout=RATE_LIMIT_TIMEOUT):
+        self.rpm = rpm
+        self.tpm = tpm
+        self.store = store or MemoryBucketStore()
+        self.timeout = timeout
+        self.waited = 0.0
+        self.rejected = 0
+
+    def try_acquire(self, tokens):
+        """Take budget for one request if available; otherwise return seconds to wait"""
+        tokens = min(tokens, self.tpm)
+
+        def update(state):
+            now = time.time()
+            if state is None:
+                state = {'requests': self.rpm, 'tokens': self.tpm, 'updated': now}
+            elapsed = max(0.0, now - state['updated'])
+            requests = min(self.rpm, state['requests'] + elapsed * self.rpm / 60)
+            available = min(self.tpm, state['tokens'] + elapsed * self.tpm / 60)
+            if requests >= 1 and available >= tokens:
+                return {'requests': requests - 1, 'tokens': available - tokens, 'updated': now}, 0.0
+            wait = max((1 - requests) * 60 / self.rpm, (tokens - available) * 60 / self.tpm)
+            return {'requests': requests, 'tokens': available, 'updated': now}, wait
+
+        return self.store.transact(update)
+
+    def acquire(self, tokens, timeout=None):
+        """Queue until budget is available, raising RateLimitExceeded after the timeout"""
+        timeout = self.timeout if timeout is None else timeout
+        deadline = time.monotonic() + timeout
+        while True:
+            wait = self.try_acquire(tokens)
+            if wait <= 0:
+                return
+            remaining = deadline - time.monotonic()
+            if wait > remaining:
+                self.rejected += 1
+                raise RateLimitExceeded(f"Rate limit budget not available within {timeout:.0f}s")
+            self.waited += wait
+            time.sleep(wait)
+
+    def snapshot(self):
+        return {'rpm': self.rpm, 'tpm': self.tpm, 'waited': round(self.waited, 3), 'rejected': self.rejected}
+
+
+# Where per-call metrics go: any of log, memory, prometheus (comma separated)
+METRICS_SINKS = [s.strip() for s in os.getenv('METRICS_SINKS', 'log,memory').split(',') if s.strip()]
+# Calls kept by the memory sink for the debug panel
+METRICS_BUFFER_SIZE = int(os.getenv('METRICS_BUFFER_SIZE', 200))
+# Port serving the Prometheus text format at /metrics; unset disables the endpoint
+METRICS_PORT = os.getenv('METRICS_PORT')
+# Show recent model calls and engine state below the chat
+DEBUG_PANEL = os.getenv('DEBUG_PANEL', 'false').lower() == 'true'
+LATENCY_BUCKETS = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)  # Seconds
+
+
+class CallMetrics:
+    """Timing, token and retry details of one model call"""
+
+    def __init__(self, caller, model_name, stream=False):
+        self.caller = caller
+        self.model = model_name
+        self.stream = stream
+        self.timestamp = time.time()
+        self.start = time.perf_counter()
+        self.ttfb = None
+        self.latency = None
+        self.prompt_tokens = None
+        self.response_tokens = None
+        self.retries = 0
+        self.cache_hit = False
+        self.ok = False
+
+    def first_byte(self):
+        """Mark the moment the first response text was available"""
+        if self.ttfb is None:
+            self.ttfb = time.perf_counter() - self.start
+
+    def record_usage(self, response):
+        """Take token counts from a response's usage metadata when present"""
+        usage = getattr(response, 'usage_metadata', None)
+        if usage is None:
+            return
+        self.prompt_tokens = getattr(usage, 'prompt_token_count', None) or self.prompt_tokens
+        self.response_tokens = getattr(usage, 'candidates_token_count', None) or self.response_tokens
+
+    def finish(self, ok):
+        self.ok = ok
+        self.latency = time.perf_counter() - self.start
+
+    def to_dict(self):
+        return {
+            'timestamp': round(self.timestamp, 3),
+            'caller': self.caller,
+            'model': self.model,
+            'stream': self.stream,
+            'ok': self.ok,
+            'cache_hit': self.cache_hit,
+            'retries': self.retries,
+            'prompt_tokens': self.prompt_tokens,
+            'response_tokens': self.response_tokens,
+            'ttfb_ms': None if self.ttfb is None else round(self.ttfb * 1000, 1),
+            'latency_ms': None if self.latency is None else round(self.latency * 1000, 1),
+        }
+
+
+class LogSink:
+    """Prints one JSON line per call"""
+
+    def record(self, call):
+        print(f"Model call {json.dumps(call.to_dict(), separators=(',', ':'))}")  # Debug log
+
+
+class MemorySink:
+    """Keeps the most recent calls for the debug panel"""
+
+    def __init__(self, size=METRICS_BUFFER_SIZE):
+        self.calls = deque(maxlen=size)
+        self.lock = threading.Lock()
+
+    def record(self, call):
+        with self.lock:
+            self.calls.append(call.to_dict())
+
+    def recent(self):
+        """Return the buffered calls, newest first"""
+        with self.lock:
+            return list(reversed(self.calls))
+
+
+class PrometheusSink:
+    """Aggregates calls into Prometheus counters and histograms"""
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counters = {}  # (metric, labels) -> value
+        self.histograms = {}  # (metric, caller) -> [bucket counts..., sum, count]
+        self.lock = threading.Lock()
+
+    def increment(self, metric, labels, value=1):
+        key = (metric, labels)
+        self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, metric, caller, seconds):
+        histogram = self.histograms.setdefault((metric, caller), [0] * (len(self.buckets) + 2))
+        for i, bound in enumerate(self.buckets):
+            if seconds <= bound:
+                histogram[i] += 1
+        histogram[-2] += seconds
+        histogram[-1] += 1
+
+    def record(self, call):
+        caller = f'caller="{call.caller}"'
+        with self.lock:
+            self.increment('travel_planner_model_calls_total', f'{caller},ok="{str(call.ok).lower()}"')
+            self.increment('travel_planner_model_retries_total', caller, call.retries)
+            if call.cache_hit:
+                self.increment('travel_planner_model_cache_hits_total', caller)
+                return
+            self.increment('travel_planner_model_tokens_total', f'{caller},kind="prompt"', call.prompt_tokens or 0)
+            self.increment('travel_planner_model_tokens_total', f'{caller},kind="response"', call.response_tokens or 0)
+            self.observe('travel_planner_model_latency_seconds', call.caller, call.latency)
+            if call.ttfb is not None:
+                self.observe('travel_planner_model_ttfb_seconds', call.caller, call.ttfb)
+
+    def render(self):
+        """Return all metrics in the Prometheus text exposition format"""
+        lines = []
+        with self.lock:
+            for metric in sorted({metric for metric, _ in self.counters}):
+                lines.append(f"# TYPE {metric} counter")
+                for (name, labels), value in sorted(self.counters.items()):
+                    if name == metric:
+                        lines.append(f"{metric}{{{labels}}} {value}")
+            for metric in sorted({metric for metric, _ in self.histograms}):
+                lines.append(f"# TYPE {metric} histogram")
+                for (name, caller), histogram in sorted(self.histograms.items()):
+                    if name != metric:
+                        continue
+                    for bound, count in zip(self.buckets, histogram):
+                        lines.append(f'{metric}_bucket{{caller="{caller}",le="{bound}"}} {count}')
+                    lines.append(f'{metric}_bucket{{caller="{caller}",le="+Inf"}} {histogram[-1]}')
+                    lines.append(f'{metric}_sum{{caller="{caller}"}} {histogram[-2]:.6f}')
+                    lines.append(f'{metric}_count{{caller="{caller}"}} {histogram[-1]}')
+        return '\n'.join(lines) + '\n'
+
+
+METRICS_SINK_TYPES = {'log': LogSink, 'memory': MemorySink, 'prometheus': PrometheusSink}
+
+
+class Metrics:
+    """Fans call metrics out to the configured sinks, keyed by sink name"""
+
+    def __init__(self, sinks):
+        self.sinks = sinks
+
+    def record(self, call):
+        for sink in self.sinks.values():
+            try:
+                sink.record(call)
+            except Exception as e:
+                print(f"Metrics sink error: {str(e)}")
+
+    def sink(self, name):
+        """Return the sink registered under a name, or None"""
+        return self.sinks.get(name)
+
+
+def start_metrics_server(sink, port):
+    """Serve sink.render() at /metrics on a daemon thread"""
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split('?')[0] != '/metrics':
+                self.send_error(404)
+                return
+            body = sink.render().encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer(('', port), MetricsHandler)
+    threading.Thread(target=server.serve_forever, name='metrics', daemon=True).start()
+    print(f"Serving Prometheus metrics on port {port}")  # Debug log
+    return server
+
+
+@st.cache_resource(show_spinner=False)
+def get_metrics():
+    """Return the process-wide metrics fan-out built from METRICS_SINKS"""
+    names = list(METRICS_SINKS)
+    if METRICS_PORT and 'prometheus' not in names:
+        names.append('prometheus')
+    metrics = Metrics({name: METRICS_SINK_TYPES[name]() for name in names if name in METRICS_SINK_TYPES})
+    if METRICS_PORT:
+        try:
+            start_metrics_server(metrics.sink('prometheus'), int(METRICS_PORT))
+        except OSError as e:
+            print(f"Could not start metrics server: {str(e)}")
+    return metrics
+
+
+# Maximum Gemini requests in flight per process, shared by every caller
+MAX_CONCURRENT_REQUESTS = int(os.getenv('MAX_CONCURRENT_REQUESTS', 4))
+
+
+class RequestEngine:
+    """Process-wide Gemini request path with caching, retries and a concurrency cap"""
+
+    def __init__(self, cache, max_concurrent=MAX_CONCURRENT_REQUESTS, retry_policy=None, breaker=None,
+                 limiter=None, metrics=None):
+        self.cache = cache
+        self.metrics = metrics
+        self.retry_policy = retry_policy or RetryPolicy()
+        self.breaker = breaker or CircuitBreaker()
+        self.limiter = limiter or TokenBucketLimiter(
+            store=FileBucketStore(RATE_LIMIT_STATE) if RATE_LIMIT_STATE else None
+        )
+        self.slots = threading.BoundedSemaphore(max_concurrent)
+        self.executor = ThreadPoolExecutor(max_workers=max_concurrent, thread_name_prefix='gemini')
+
+    def generate(self, model, prompt, use_cache=True, generation_config=None, caller='other', fallback=None,
+                 deadline=None):
+        """Return the response text for a prompt, or None after all retries fail
+
+        If the model times out and a fallback model is given, the prompt goes
+        to the fallback instead of being retried on the same model. With a
+        deadline, attempts, waits, backoff and the fallback all share its budget.
+        """
+        model_name = getattr(model, 'model_name', MODEL_NAME)
+        cache_key = make_cache_key(model_name, prompt, generation_config, caller)
+        options = {'generation_config': generation_config} if generation_config else {}
+        call = CallMetrics(caller, model_name)
+        text = None
+        try:
+            if use_cache:
+                text = self.cache.get(cache_key)
+                if text is not None:
+                    call.cache_hit = True
+                    call.first_byte()
+                    return text
+
+            print(f"Sending prompt to Gemini: {prompt[:100]}...")  # Debug log
+
+            # Generate response with retry logic
+            for attempt in range(self.retry_policy.max_attempts):
+                call.retries = attempt
+                probe = False
+                try:
+                    probe = self.check_breaker()
+                    self.limiter.acquire(estimate_tokens(prompt), timeout=self.wait_budget(deadline))
+                    self.acquire_slot(deadline)
+                    try:
+                        response = model.generate_content(
+                            prompt, **options, **self.request_options(deadline, fallback)
+                        )
+                    finally:
+                        self.slots.release()
+                    call.first_byte()
+                    call.record_usage(response)
+                    self.breaker.record_success()
+                    if response and response.text:
+                        text = response.text.strip()
+                        self.cache.set(cache_key, text)
+                        return text
+                except (CircuitOpenError, RateLimitExceeded, DeadlineExpired) as fail_fast_error:
+                    print(str(fail_fast_error))
+                    return None
+                except Exception as retry_error:
+                    print(f"Retry error: {str(retry_error)}")
+                    if fallback is not None and is_timeout(retry_error):
+                        self.breaker.record_failure()
+                        break
+                    if not self.should_retry(attempt, retry_error, deadline):
+                        return None
+                finally:
+                    # Fatal errors, fail-fast exits and abandoned calls never reach a verdict
+                    if probe:
+                        self.breaker.release_probe()
+            else:
+                return None
+        finally:
+            self.record(call, text is not None)
+
+        print(f"{model_name} timed out; falling back to {getattr(fallback, 'model_name', 'fallback model')}")
+        return self.generate(fallback, prompt, use_cache, generation_config, caller, deadline=deadline)
+
+    def stream(self, model, prompt, use_cache=True, caller='other', fallback=None, generation_config=None,
+               deadline=None):
+        """Yield response text chunks as they arrive
+
+        Yields nothing if the call fails before the first chunk, and raises
+        StreamInterrupted if it fails after, so callers can tell a cut-short
+        answer from a complete one. A timeout before the first chunk moves the
+        prompt to the fallback model, if given. With a deadline, the whole
+        stream must finish within its budget.
+        """
+        model_name = getattr(model, 'model_name', MODEL_NAME)
+        cache_key = make_cache_key(model_name, prompt, generation_config, caller)
+        options = {'generation_config': generation_config} if generation_config else {}
+        call = CallMetrics(caller, model_name, stream=True)
+        completed = False
+        try:
+            if use_cache:
+                cached = self.cache.get(cache_key)
+                if cached is not None:
+                    call.cache_hit = True
+                    call.first_byte()
+                    completed = True
+                    yield cached
+                    return
+
+            print(f"Streaming prompt to Gemini: {prompt[:100]}...")  # Debug log
+
+            for attempt in range(self.retry_policy.max_attempts):
+                call.retries = attempt
+                started = False
+                chunks = []
+                probe = False
+                try:
+                    probe = self.check_breaker()
+                    self.limiter.acquire(estimate_tokens(prompt), timeout=self.wait_budget(deadline))
+                    self.acquire_slot(deadline)
+                    try:
+                        # The upstream timeout covers the whole stream, so none of it is held back
+                        # for the fallback; a long answer would otherwise be cut off halfway
+                        response = model.generate_content(
+                            prompt, stream=True, **options, **self.request_options(deadline)
+                        )
+                        for chunk in response:
+                            call.record_usage(chunk)
+                            if chunk.text:
+                                call.first_byte()
+                                started = True
+                                chunks.append(chunk.text)
+                                yield chunk.text
+                    finally:
+                        self.slots.release()
+                    self.breaker.record_success()
+                    if started:
+                        self.cache.set(cache_key, ''.join(chunks).strip())
+                        completed = True
+                        return
+                except (CircuitOpenError, RateLimitExceeded, DeadlineExpired) as fail_fast_error:
+                    print(str(fail_fast_error))
+                    return
+                except Exception as retry_error:
+                    print(f"Retry error: {str(retry_error)}")
+                    if started:  # Part of the answer is already on screen
+                        self.breaker.record_failure()
+                        raise StreamInterrupted(f"Stream from {model_name} ended early: {retry_error}")
+                    if fallback is not None and is_timeout(retry_error):
+                        self.breaker.record_failure()
+                        break
+                    if not self.should_retry(attempt, retry_error, deadline):
+                        return
+                finally:
+                    if probe:
+                        self.breaker.release_probe()
+            else:
+                return
+        finally:
+            self.record(call, completed)
+
+        print(f"{model_name} timed out; falling back to {getattr(fallback, 'model_name', 'fallback model')}")
+        yield from self.stream(fallback, prompt, use_cache, caller, generation_config=generation_config,
+                               deadline=deadline)
+
+    def wait_budget(self, deadline):
+        """Longest a call may queue for rate limit budget; raises DeadlineExpired if none is left"""
+        remaining = self.remaining(deadline)
+        if remaining is None:
+            return None
+        return min(self.limiter.timeout, remaining)
+
+    def acquire_slot(self, deadline):
+        """Wait for a free request slot, but not past the deadline"""
+        if not self.slots.acquire(timeout=self.remaining(deadline)):
+            raise DeadlineExpired(f"No request slot freed within the {deadline.seconds:g}s budget")
+
+    def request_options(self, deadline, fallback=None):
+        """Per-attempt upstream timeout; a non-streaming call leaves half the budget for its fallback tier"""
+        timeout = self.remaining(deadline)
+        if timeout is None:
+            return {}
+        if fallback is not None:
+            timeout /= 2
+        return {'request_options': {'timeout': timeout}}
+
+    @staticmethod
+    def remaining(deadline):
+        """Seconds left on an optional deadline, or None for no limit; raises DeadlineExpired if spent"""
+        if deadline is None:
+            return None
+        deadline.check()
+        return deadline.remaining()
+
+    def record(self, call, ok):
+        """Close out a call's metrics and hand them to the sinks"""
+        call.finish(ok)
+        if self.metrics is not None:
+            self.metrics.record(call)
+
+    def check_breaker(self):
+        """Raise CircuitOpenError if the upstream is considered degraded; True if this call is the probe"""
+        admitted = self.breaker.admit()
+        if admitted is None:
+            raise CircuitOpenError("Gemini circuit breaker is open; failing fast")
+        return admitted == CircuitBreaker.HALF_OPEN
+
+    def should_retry(self, attempt, error, deadline=None):
+        """Record a failed attempt and sleep before the next one if it is worth retrying"""
+        if not is_retryable(error):
+            return False
+        self.breaker.record_failure()
+        if attempt + 1 >= self.retry_policy.max_attempts:
+            return False
+        delay = self.retry_policy.backoff(attempt, error)
+        remaining = None if deadline is None else deadline.remaining()
+        if remaining is not None and delay >= remaining:
+            print(f"Not retrying: backoff of {delay:.1f}s would pass the deadline")  # Debug log
+            return False
+        self.retry_policy.sleep(delay)
+        return True
+
+    def status(self):
+        """Engine state for monitoring"""
+        return {
+            'breaker': self.breaker.snapshot(),
+            'cache': self.cache.stats(),
+            'rate_limit': self.limiter.snapshot(),
+        }
+
+
+@st.cache_resource(show_spinner=False)
+def get_engine():
+    """Return the process-wide request engine"""
+    return RequestEngine(get_response_cache(), metrics=get_metrics())
+
+
+def report_failure():
+    """Flag the shared client for a new health check and tell the user"""
+    client = get_model_client(MODEL_NAME, os.getenv('GOOGLE_API_KEY'))
+    client.mark_unhealthy()
+    if get_engine().breaker.snapshot()['state'] == CircuitBreaker.OPEN:
+        st.error("Gemini API is temporarily unavailable. Please try again in a moment.")
+    else:
+        st.error("Failed to get response from Gemini API after multiple attempts")
+
+TIMEOUT_MESSAGES = {
+    'extract': "Gemini is slow right now, so I read your message with a simpler parser. Please check the details below.",
+    'turn': "Gemini is slow right now, so I read your message with a simpler parser. Please check the details below.",
+    'itinerary': "Gemini couldn't finish your itinerary. Here is what I have so far.",
+    'itinerary_section': "Gemini couldn't finish your itinerary. Here is what I have so far.",
+}
+
+def report_timeout(task):
+    """Tell the user a request ran out of time and a simpler answer follows"""
+    st.warning(TIMEOUT_MESSAGES.get(task, "Gemini took too long to respond. Please try again."))
+
+def report_unanswered(task, deadline):
+    """Report a request that returned nothing as a timeout or a failure"""
+    if deadline.expired():
+        report_timeout(task)
+    else:
+        report_failure()
+
+def get_ai_response(prompt, use_cache=True, generation_config=None, task='other', deadline=None):
+    """Get response from Gemini API using the shared model for the task"""
     try:
         # Get model from session state
         if 'model' not in st.session_state:
             st.error("Model not initialized")
             return None
-            
-        model = st.session_state.model
-        print(f"Sending prompt to Gemini: {prompt[:100]}...")  # Debug log
-        
-        # Generate response with retry logic
-        for _ in range(3):  # Try up to 3 times
-            try:
-                response = model.generate_content(prompt)
-                if response and response.text:
-                    return response.text.strip()
-            except Exception as retry_error:
-                print(f"Retry error: {str(retry_error)}")
-                time.sleep(1)  # Wait 1 second before retrying
-                continue
-                
-        st.error("Failed to get response from Gemini API after multiple attempts")
-        return None
+
+        deadline = deadline or task_deadline(task)
+        response = resolve_route(task, generation_config).generate(get_engine(), prompt, use_cache, deadline)
+        if response is None:
+            report_unanswered(task, deadline)
+        return response
     except Exception as e:
         st.error(f"Error getting AI response: {str(e)}")
         print(f"Detailed error: {str(e)}")  # Debug log
         return None
 
-def extract_preferences(user_input):
-    """Extract user preferences from input"""
-    prompt = f"""As a travel planning assistant, analyze this input and extract travel preferences.
-    Return a detailed JSON object with:
-    - budget (exact amount or level: budget-friendly/mid-range/luxury)
-    - duration (number of days)
-    - destination (specific place)
-    - starting_location (departure city/place)
-    - purpose (main goal: relaxation/adventure/culture/etc)
-    - preferences (list of specific activities/interests mentioned)
-    - dietary_restrictions (any food preferences/restrictions)
-    - mobility_concerns (any physical considerations)
-    - accommodation_preferences (preferred stay type)
-    
-    Consider context and implied preferences.
-    Set fields to null if not mentioned.
-    For lists, return null if empty.
-    
-    User input: {user_input}
-    
-    Return only the JSON object."""
-    
-    response = get_ai_response(prompt)
-    if response:
+# Minimum confidence for the local extractor to answer without calling Gemini
+LOCAL_EXTRACTION_CONFIDENCE = 0.8
+
+NUMBER_WORDS = {
+    'a': 1, 'an': 1, 'one': 1, 'two': 2, 'three': 3, 'four': 4, 'five': 5,
+    'six': 6, 'seven': 7, 'eight': 8, 'nine': 9, 'ten': 10, 'fourteen': 14,
+}
+DURATION_PATTERN = re.compile(
+    r'\b(\d+|' + '|'.join(NUMBER_WORDS) + r')\s*(?:-\s*)?(days?|nights?|weeks?)\b'
+)
+BUDGET_PATTERN = re.compile(
+    r'\b(' + '|'.join(sorted((re.escape(w) for ws in BUDGET_LEVELS.values() for w in ws), key=len, reverse=True)) + r')\b'
+)
+AMOUNT_PATTERN = re.compile(
+    r'(?:[$€£₹]\s?\d[\d,]*(?:\.\d+)?\s?k?'
+    r'|\b\d[\d,]*(?:\.\d+)?\s?k?\s?(?:usd|dollars?|eur|euros?|gbp|pounds?|inr|rupees?|rs)\b)'
+)
+DESTINATIONS = [
+    'Paris', 'London', 'Rome', 'Barcelona', 'Amsterdam', 'Prague', 'Vienna', 'Berlin', 'Lisbon',
+    'Madrid', 'Venice', 'Florence', 'Athens', 'Santorini', 'Istanbul', 'Dubai', 'New York', 'Los Angeles',
+    'San Francisco', 'Las Vegas', 'Chicago', 'Miami', 'Toronto', 'Vancouver', 'Mexico City', 'Cancun',
+    'Rio de Janeiro', 'Buenos Aires', 'Lima', 'Cusco', 'Tokyo', 'Kyoto', 'Osaka', 'Seoul', 'Beijing',
+    'Shanghai', 'Hong Kong', 'Singapore', 'Bangkok', 'Phuket', 'Bali', 'Hanoi', 'Kuala Lumpur', 'Sydney',
+    'Melbourne', 'Auckland', 'Cape Town', 'Marrakech', 'Cairo', 'Nairobi', 'Delhi', 'New Delhi', 'Mumbai',
+    'Bangalore', 'Bengaluru', 'Chennai', 'Kolkata', 'Hyderabad', 'Pune', 'Jaipur', 'Udaipur', 'Agra',
+    'Goa', 'Kerala', 'Manali', 'Shimla', 'Rishikesh', 'Varanasi', 'Ladakh', 'Leh', 'Darjeeling',
+    'Kathmandu', 'Colombo', 'Maldives', 'Iceland', 'Switzerland', 'Italy', 'France', 'Spain', 'Japan',
+    'Thailand', 'Vietnam', 'Greece', 'Portugal', 'Peru', 'Egypt', 'Morocco', 'Australia', 'New Zealand',
+]
+DESTINATION_PATTERN = re.compile(
+    r'\b(' + '|'.join(sorted((re.escape(d.lower()) for d in DESTINATIONS), key=len, reverse=True)) + r')\b'
+)
+DESTINATION_NAMES = {d.lower(): d for d in DESTINATIONS}
+NEGATIVE_ANSWERS = {'no', 'none', 'nope', 'nothing', 'nah', 'n/a', 'na', 'not really', 'no thanks', 'no preference'}
+# Words that carry no preference information of their own
+FILLER_WORDS = {
+    'i', 'im', 'we', 'want', 'would', 'like', 'to', 'go', 'for', 'about', 'around', 'maybe', 'a', 'an',
+    'the', 'of', 'trip', 'travel', 'visit', 'visiting', 'stay', 'from', 'in', 'my', 'our', 'is', 'be',
+    'it', 'and', 'level', 'range', 'please', 'just', 'me', 'us', 'starting', 'start', 'leaving', 'budget',
+}
+
+
+class ExtractionStats:
+    """Process-wide counts of local fast-path hits and model fallbacks"""
+
+    def __init__(self):
+        self.local = 0
+        self.model = 0
+        self.lock = threading.Lock()
+
+    def record(self, local):
+        with self.lock:
+            if local:
+                self.local += 1
+            else:
+                self.model += 1
+
+    def hit_rate(self):
+        total = self.local + self.model
+        return self.local / total if total else 0.0
+
+
+@st.cache_resource(show_spinner=False)
+def get_extraction_stats():
+    """Return the process-wide extraction counters"""
+    return ExtractionStats()
+
+
+def extract_preferences_locally(user_input, pending_field=None):
+    """Extract simple answers without the model; returns (preferences, confidence)"""
+    text = user_input.lower().strip().rstrip('.!')
+    prefs = {}
+    spans = []
+
+    if text in NEGATIVE_ANSWERS and pending_field:
+        return prefs, 1.0
+
+    match = DURATION_PATTERN.search(text)
+    if match:
+        count = match.group(1)
+        days = int(count) if count.isdigit() else NUMBER_WORDS[count]
+        prefs['duration'] = days * 7 if match.group(2).startswith('week') else days
+        spans.append(match.span())
+    elif pending_field == 'duration' and re.fullmatch(r'\d{1,3}', text):
+        prefs['duration'] = int(text)
+        spans.append((0, len(text)))
+
+    match = AMOUNT_PATTERN.search(text)
+    if match:
+        prefs['budget'] = user_input.strip()[match.start():match.end()].strip()
+        spans.append(match.span())
+    else:
+        match = BUDGET_PATTERN.search(text)
+        if match and (match.group(1) != 'budget' or pending_field == 'budget' or text == 'budget'):
+            prefs['budget'] = next(level for level, words in BUDGET_LEVELS.items() if match.group(1) in words)
+            # "luxury" or "cheap" may describe whatever was just asked about, e.g. the accommodation,
+            # so the keyword only counts as explained when the budget was the question
+            if pending_field == 'budget':
+                spans.append(match.span())
+
+    places = list(DESTINATION_PATTERN.finditer(text))
+    for match in places:
+        name = DESTINATION_NAMES[match.group(1)]
+        before = text[:match.start()].split()[-1:]
+        if before == ['from']:
+            field = 'starting_location'
+        elif before == ['to'] or (len(places) == 1 and pending_field != 'starting_location'):
+            field = 'destination'
+        elif len(places) == 1:
+            field = 'starting_location'
+        else:
+            return {}, 0.0  # Several places without clear roles
+        prefs[field] = name
+        spans.append(match.span())
+
+    if not prefs:
+        return prefs, 0.0
+
+    # Confidence is the share of meaningful words explained by the matches
+    remaining = text
+    for start, end in sorted(spans, reverse=True):
+        remaining = remaining[:start] + ' ' + remaining[end:]
+    leftover = [w for w in re.findall(r"[a-z0-9']+", remaining) if w not in FILLER_WORDS]
+    words = [w for w in re.findall(r"[a-z0-9']+", text) if w not in FILLER_WORDS]
+    return prefs, 1.0 - len(leftover) / max(len(words), 1)
+
+PREFERENCES_SCHEMA = {
+    'type': 'object',
+    'properties': {
+        field: ({'type': 'array', 'items': {'type': 'string'}, 'nullable': True} if kind == 'array'
+                else {'type': kind, 'nullable': True})
+        for field, kind in PREFERENCE_FIELDS.items()
+    },
+}
+# Model families that accept response_mime_type and response_schema
+STRUCTURED_OUTPUT_MODELS = ('gemini-1.5', 'gemini-2')
+
+
+def supports_structured_output(model):
+    """Whether the model can be asked for schema-constrained JSON"""
+    name = getattr(model, 'model_name', MODEL_NAME).replace('models/', '')
+    return name.startswith(STRUCTURED_OUTPUT_MODELS)
+
+
+class JSONObjectScanner:
+    """Finds the first complete JSON object in text fed piece by piece"""
+
+    def __init__(self):
+        self.buffer = []
+        self.depth = 0
+        self.in_string = False
+        self.escaped = False
+
+    def feed(self, text):
+        """Consume more text; return the parsed object once it is complete, else None"""
+        for char in text:
+            if self.depth == 0 and char != '{':
+                continue  # Skip prose and code fences before the object
+            self.buffer.append(char)
+            if self.in_string:
+                if self.escaped:
+                    self.escaped = False
+                elif char == '\\':
+                    self.escaped = True
+                elif char == '"':
+                    self.in_string = False
+            elif char == '"':
+                self.in_string = True
+            elif char == '{':
+                self.depth += 1
+            elif char == '}':
+                self.depth -= 1
+                if self.depth == 0:
+                    candidate = ''.join(self.buffer)
+                    self.buffer = []
+                    try:
+                        return json.loads(candidate)
+                    except json.JSONDecodeError:
+                        continue  # Not valid JSON; keep looking for the next object
+        return None
+
+
+def extract_json_object(text):
+    """Return the first JSON object embedded in model output, or None"""
+    return JSONObjectScanner().feed(text)
+
+
+def validate_preferences(data):
+    """Coerce extracted values to the expected types, dropping anything invalid"""
+    if not isinstance(data, dict):
+        return None
+    prefs = {}
+    for field, kind in PREFERENCE_FIELDS.items():
+        value = data.get(field)
+        if value in (None, '', []):
+            continue
         try:
-            response = response.strip()
-            if response.startswith('```json'):
-                response = response[7:]
-            if response.endswith('```'):
-                response = response[:-3]
-            prefs = json.loads(response)
-            # Convert empty lists to None
-            for key in ['preferences', 'dietary_restrictions']:
-                if key in prefs and (not prefs[key] or prefs[key] == []):
-                    prefs[key] = None
-            return prefs
-        except Exception as e:
-            print(f"Error parsing JSON response: {str(e)}")
-            return None
+            if kind == 'integer':
+                if isinstance(value, str):
+                    value = re.search(r'\d+', value).group()
+                value = int(value)
+                if value <= 0:
+                    continue
+            elif kind == 'array':
+                items = value if isinstance(value, list) else [value]
+                value = [str(item).strip() for item in items if item not in (None, '')]
+                if not value:
+                    continue
+            else:
+                value = str(value).strip()
+        except (AttributeError, TypeError, ValueError):
+            print(f"Dropping invalid {field} value: {value!r}")  # Debug log
+            continue
+        prefs[field] = value
+    return prefs
+
+def try_local_extraction(user_input, pending_field=None):
+    """Return locally extracted preferences if confident enough, else None"""
+    stats = get_extraction_stats()
+    local_prefs, confidence = extract_preferences_locally(user_input, pending_field)
+    stats.record(confidence >= LOCAL_EXTRACTION_CONFIDENCE)
+    print(f"Local extraction confidence {confidence:.2f}, hit rate {stats.hit_rate():.0%}")  # Debug log
+    return local_prefs if confidence >= LOCAL_EXTRACTION_CONFIDENCE else None
+
+# Lower bar for the local extractor once the model has run out of time
+DEGRADED_EXTRACTION_CONFIDENCE = 0.5
+
+def degraded_extraction(user_input, current, pending_field=None):
+    """Local guess at the preferences once the model ran out of time
+
+    Below full confidence a guess must not overwrite what is known, so only
+    fields still missing are filled, and only if the guess is fair.
+    """
+    local_prefs, confidence = extract_preferences_locally(user_input, pending_field)
+    print(f"Extraction timed out; local result has confidence {confidence:.2f}")  # Debug log
+    if confidence < DEGRADED_EXTRACTION_CONFIDENCE:
+        return None
+    return {field: value for field, value in local_prefs.items() if current.is_missing(field)} or None
+
+PREFERENCE_INSTRUCTION = """You update a traveller's trip preferences from their latest chat message.
+Fields: budget (amount or budget-friendly/mid-range/luxury), duration (days), destination, starting_location, purpose, preferences (list), dietary_restrictions (list), mobility_concerns, accommodation_preferences
+Consider context and implied preferences."""
+# Static extraction instructions, sent as the model's system instruction instead of in every prompt
+EXTRACTION_INSTRUCTION = PREFERENCE_INSTRUCTION + "\nReturn a JSON object with only the fields the message adds or changes."
+
+def build_targeted_prompt(user_input, current, pending_field):
+    """Build the per-request part of the extraction prompt: known fields and the new message"""
+    known = {k: v for k, v in current.items() if v not in (None, [])}
+    return f"""Known: {json.dumps(known, ensure_ascii=False, separators=(',', ':'))}
+Just asked about: {pending_field or 'nothing specific'}
+User message: {user_input}"""
+
+def extract_preferences(user_input, current=None, pending_field=None):
+    """Extract user preferences from input
+
+    The model only returns a patch of the fields that changed relative to the
+    current preferences instead of all nine.
+    """
+    if pending_field is None:
+        pending_field = st.session_state.get('pending_field')
+    local_prefs = try_local_extraction(user_input, pending_field)
+    if local_prefs is not None:
+        return local_prefs
+
+    if current is None:
+        current = TravelPreferences()
+    prompt = build_targeted_prompt(user_input, current, pending_field)
+
+    generation_config = None
+    if supports_structured_output(get_task_model('extract')):
+        generation_config = {'response_mime_type': 'application/json', 'response_schema': PREFERENCES_SCHEMA}
+
+    deadline = task_deadline('extract')
+    response = get_ai_response(prompt, generation_config=generation_config, task='extract', deadline=deadline)
+    if response is None and deadline.expired():
+        return degraded_extraction(user_input, current, pending_field)
+    if response:
+        prefs = validate_preferences(extract_json_object(response))
+        if prefs is None:
+            print(f"Error parsing JSON response: {response[:100]}")
+        return prefs
     return None
 
+def merge_preferences(current, patch):
+    """Apply an extracted patch to the current preferences in place
+
+    Missing or null values never erase what is known. List fields are merged
+    without duplicates; any other field takes the newer value, since the user
+    restating a field is a correction. Returns the names of changed fields.
+    """
+    changed = []
+    for key, value in (patch or {}).items():
+        if key not in current or value is None:
+            continue
+        old = current[key]
+        if isinstance(value, list):
+            seen = {str(item).lower() for item in old or []}
+            additions = [item for item in value if str(item).lower() not in seen]
+            if not additions:
+                continue
+            value = list(old or []) + additions
+        elif value == old:
+            continue
+        current[key] = value
+        changed.append(key)
+    return changed
+
+# Priority order for questions
+QUESTION_PRIORITY = ['budget', 'duration', 'destination', 'starting_location', 'purpose', 'preferences',
+                     'accommodation_preferences', 'dietary_restrictions', 'mobility_concerns']
+
+def get_missing_fields(preferences):
+    """Missing preference fields in question priority order"""
+    return [field for field in QUESTION_PRIORITY if preferences.is_missing(field)]
+
+def get_unasked_fields(preferences, asked):
+    """Missing fields still worth asking about: essentials until answered, optional ones only once"""
+    return [field for field in get_missing_fields(preferences) if field in ESSENTIAL_FIELDS or field not in asked]
+
 def get_next_question(preferences):
     """Get the next question to ask based on missing information"""
-    missing_fields = [k for k, v in preferences.items() if v is None]
-    if not missing_fields:
+    if not preferences.missing:
         return None
     
     # Create a mapping of fields to conversational questions
@@ -146,75 +1629,975 @@ def get_next_question(preferences):
         'accommodation_preferences': "What type of accommodation would you prefer? (e.g., hotel, guesthouse, hostel)"
     }
     
-    # Priority order for questions
-    priority_fields = ['budget', 'duration', 'destination', 'starting_location', 'purpose', 'preferences', 
-                      'accommodation_preferences', 'dietary_restrictions', 'mobility_concerns']
-    
     # Get the first missing field by priority that hasn't been asked yet
-    for field in priority_fields:
-        if field in missing_fields and field not in st.session_state.asked_questions:
+    for field in QUESTION_PRIORITY:
+        if preferences.is_missing(field) and field not in st.session_state.asked_questions:
             st.session_state.asked_questions.add(field)
+            st.session_state.pending_field = field
             return questions.get(field)
     
     return None
 
-def generate_itinerary(preferences):
-    """Generate a detailed travel itinerary based on preferences"""
-    # Create a dynamic prompt based on user preferences
-    prompt = f"""Create a personalized {preferences['duration']}-day trip itinerary.
+# Extract preferences and pick the follow-up question in one model call
+TURN_PIPELINE = os.getenv('TURN_PIPELINE', 'true').lower() == 'true'
+TURN_SCHEMA = {
+    'type': 'object',
+    'properties': {
+        'patch': PREFERENCES_SCHEMA,
+        'next_question': {'type': 'string', 'nullable': True},
+    },
+}
+TURN_INSTRUCTION = PREFERENCE_INSTRUCTION + """
+Respond with JSON: {"patch": <fields the message adds or changes>, "next_question": <one friendly question asking for every field still to ask about that this message does not answer, or null if none are left>}"""
+
+
+class TurnStats:
+    """Process-wide record of how many user turns it takes to reach an itinerary"""
+
+    def __init__(self):
+        self.sessions = 0
+        self.total_turns = 0
+        self.lock = threading.Lock()
+
+    def record(self, turns):
+        with self.lock:
+            self.sessions += 1
+            self.total_turns += turns
+
+    def average(self):
+        return self.total_turns / self.sessions if self.sessions else 0.0
+
+
+@st.cache_resource(show_spinner=False)
+def get_turn_stats():
+    """Return the process-wide turn counters"""
+    return TurnStats()
+
+
+def record_first_itinerary():
+    """Record the number of user turns it took to produce this session's first itinerary"""
+    if st.session_state.turns_to_itinerary is None:
+        st.session_state.turns_to_itinerary = st.session_state.turn_count
+        stats = get_turn_stats()
+        stats.record(st.session_state.turn_count)
+        print(f"Turns to first itinerary: {st.session_state.turn_count} (average {stats.average():.1f})")  # Debug log
+
+def build_turn_prompt(user_input, current, pending_field, asked=()):
+    """Build the per-request part of a prompt returning both the preference patch and the next question
+
+    Optional fields already asked about are left out, so ones the user skipped
+    are not asked again on every turn.
+    """
+    unasked = get_unasked_fields(current, asked)
+    return build_targeted_prompt(user_input, current, pending_field) + f"""
+Still to ask about: {', '.join(unasked) or 'nothing'}"""
+
+def run_turn(user_input, current, pending_field=None, asked=()):
+    """Extract a preference patch and a follow-up question with at most one model call
+
+    Returns (patch, next_question). next_question is None when the local
+    extractor answered or the model had nothing left to ask.
+    """
+    local_prefs = try_local_extraction(user_input, pending_field)
+    if local_prefs is not None:
+        return local_prefs, None
+
+    generation_config = None
+    if supports_structured_output(get_task_model('turn')):
+        generation_config = {'response_mime_type': 'application/json', 'response_schema': TURN_SCHEMA}
+
+    prompt = build_turn_prompt(user_input, current, pending_field, asked)
+    deadline = task_deadline('turn')
+    response = get_ai_response(prompt, generation_config=generation_config, task='turn', deadline=deadline)
+    if response is None and deadline.expired():
+        return degraded_extraction(user_input, current, pending_field), None
+    data = extract_json_object(response) if response else None
+    if not isinstance(data, dict):
+        print(f"Error parsing JSON response: {(response or '')[:100]}")
+        return None, None
+    question = data.get('next_question')
+    if not isinstance(question, str) or not question.strip():
+        question = None
+    return validate_preferences(data.get('patch') or {}), question and question.strip()
+
+# Token budgets for an itinerary request: the prompt itself and the answer it
+# asks for. Optional sections are dropped, least important first, until both fit
+ITINERARY_PROMPT_BUDGET = int(os.getenv('ITINERARY_PROMPT_BUDGET', 800))
+ITINERARY_OUTPUT_BUDGET = int(os.getenv('ITINERARY_OUTPUT_BUDGET', ITINERARY_MAX_TOKENS))
+
+FIELD_LABELS = {
+    'destination': 'Destination',
+    'starting_location': 'Starting Location',
+    'duration': 'Trip Length (days)',
+    'budget': 'Budget Level',
+    'purpose': 'Trip Purpose',
+    'accommodation_preferences': 'Accommodation Type',
+    'dietary_restrictions': 'Dietary Needs',
+    'mobility_concerns': 'Mobility Considerations',
+    'preferences': 'Activity Preferences',
+}
+TRIP_DETAIL_FIELDS = ['destination', 'starting_location', 'budget', 'purpose', 'accommodation_preferences',
+                      'dietary_restrictions', 'mobility_concerns', 'preferences']
+
+
+def format_prompt_value(value):
+    """Render a preference value compactly, e.g. 'hiking, museums' rather than a list repr"""
+    if isinstance(value, (list, tuple, set)):
+        return ', '.join(str(v) for v in value)
+    return str(value)
+
+
+class PromptTemplate:
+    """Prompt text whose static parts are dedented and parsed once, at import time"""
+
+    def __init__(self, text):
+        self.text = textwrap.dedent(text).strip('\n')
+        self.fields = {field for _, field, _, _ in string.Formatter().parse(self.text) if field}
+
+    def render(self, **values):
+        return self.text.format_map({field: format_prompt_value(values[field]) for field in self.fields})
+
+
+class PromptSection:
+    """One part of the itinerary and the output it is expected to produce"""
+
+    def __init__(self, name, title, description, output_tokens, per_day=False):
+        self.name = name
+        self.title = title
+        self.description = description
+        self.output_tokens = output_tokens
+        self.per_day = per_day
+
+    def expected_output(self, duration):
+        return self.output_tokens * (duration if self.per_day else 1)
+
+
+ITINERARY_SECTIONS = [
+    PromptSection('travel', "Travel Plan",
+                  "best route from the starting location to the destination, transportation options and "
+                  "estimated travel time, recommended stops along the way", output_tokens=300),
+    PromptSection('days', "Day-by-Day Itinerary",
+                  "Day 1 is the detailed travel and arrival plan; the remaining days have daily activities "
+                  "tailored to the trip purpose, with flexible timing", output_tokens=250, per_day=True),
+    PromptSection('accommodation', "Accommodation",
+                  "currently available hotels/stays matching the budget, location recommendations based on "
+                  "the planned activities", output_tokens=300),
+    PromptSection('experiences', "Local Experiences",
+                  "current seasonal activities at the destination, local food specialties and recommended "
+                  "restaurants, cultural events or festivals if happening now", output_tokens=350),
+    PromptSection('practical', "Practical Information",
+                  "weather-appropriate activity suggestions, current local transportation options, estimated "
+                  "daily costs based on the chosen activities, local emergency contacts and medical facilities",
+                  output_tokens=300),
+]
+# Optional sections in the order they are dropped when a request is over budget
+ITINERARY_TRIM_ORDER = ['practical', 'accommodation', 'experiences']
+
+ITINERARY_GUIDANCE = """Focus on real-time recommendations and current local conditions.
+Include alternative options for flexibility."""
+# Static itinerary instructions, sent as the model's system instruction instead of in every prompt
+ITINERARY_INSTRUCTION = '\n'.join(
+    ["You are a travel planner writing personalized trip itineraries.",
+     "Write the sections a request lists, numbered in that order and covering:"]
+    + [f"- {section.title}: {section.description}" for section in ITINERARY_SECTIONS]
+    + ["Format the response in a clear, day-by-day structure.", ITINERARY_GUIDANCE]
+)
+SECTION_INSTRUCTION = f"""You are a travel planner writing one section of a personalized trip itinerary.
+Write only the requested section, without a title.
+{ITINERARY_GUIDANCE}"""
+
+# System instruction for each task; get_task_model() returns a shared model carrying it
+SYSTEM_INSTRUCTIONS = {
+    'extract': EXTRACTION_INSTRUCTION,
+    'turn': TURN_INSTRUCTION,
+    'itinerary': ITINERARY_INSTRUCTION,
+    'itinerary_section': SECTION_INSTRUCTION,
+}
+
+ITINERARY_PROMPT = PromptTemplate("""
+    Create a personalized {duration}-day trip itinerary.
 
     Trip Details:
-    - Destination: {preferences['destination']}
-    - Starting Location: {preferences['starting_location']}
-    - Budget Level: {preferences['budget']}
-    - Trip Purpose: {preferences['purpose']}
-    - Accommodation Type: {preferences['accommodation_preferences']}
-    {f"- Dietary Needs: {preferences['dietary_restrictions']}" if preferences.get('dietary_restrictions') else ""}
-    {f"- Mobility Considerations: {preferences['mobility_concerns']}" if preferences.get('mobility_concerns') else ""}
-    {f"- Activity Preferences: {preferences['preferences']}" if preferences.get('preferences') else ""}
-
-    Please provide:
-    1. Travel Plan:
-       - Best route from {preferences['starting_location']} to {preferences['destination']}
-       - Transportation options and estimated travel time
-       - Recommended stops along the way
-
-    2. Day-by-Day Itinerary:
-       - Day 1: Detailed travel and arrival plan
-       - Days 2-{preferences['duration']}: Daily activities tailored to {preferences['purpose']}
-       - Flexible timing for activities
-
-    3. Accommodation:
-       - Current available hotels/stays matching {preferences['budget']} budget
-       - Location recommendations based on planned activities
-
-    4. Local Experiences:
-       - Current seasonal activities in {preferences['destination']}
-       - Local food specialties and recommended restaurants
-       - Cultural events or festivals if happening now
-
-    5. Practical Information:
-       - Weather-appropriate activity suggestions
-       - Current local transportation options
-       - Estimated daily costs based on chosen activities
-       - Local emergency contacts and medical facilities
-
-    Format the response in a clear, day-by-day structure.
-    Focus on real-time recommendations and current local conditions.
-    Include alternative options for flexibility."""
-    
+    {details}
+
+    Sections: {sections}""")
+SECTION_PROMPT = PromptTemplate("""
+    Section of a personalized {duration}-day trip itinerary.
+
+    Trip Details:
+    {details}
+
+    Write: {instructions}""")
+
+
+def format_trip_details(preferences, fields=TRIP_DETAIL_FIELDS):
+    """One '- Label: value' line per known field, shared by the full and per-section prompts"""
+    lines = []
+    for field in fields:
+        value = preferences.get(field)
+        if value in (None, []):
+            continue
+        lines.append(f"- {FIELD_LABELS[field]}: {format_prompt_value(value)}")
+    return '\n'.join(lines)
+
+def build_itinerary_prompt(preferences, prompt_budget=ITINERARY_PROMPT_BUDGET, output_budget=ITINERARY_OUTPUT_BUDGET):
+    """Build the per-request itinerary prompt, dropping optional sections until it fits the token budgets
+
+    The prompt budget also counts the system instruction, which is billed with every call.
+    """
+    duration = int(preferences['duration'])
+    details = format_trip_details(preferences)
+    kept = list(ITINERARY_SECTIONS)
+    trim = list(ITINERARY_TRIM_ORDER)
+    while True:
+        sections = ', '.join(f"{i}. {section.title}" for i, section in enumerate(kept, 1))
+        prompt = ITINERARY_PROMPT.render(duration=duration, details=details, sections=sections)
+        prompt_tokens = estimate_tokens(prompt) + estimate_tokens(ITINERARY_INSTRUCTION)
+        output_tokens = sum(section.expected_output(duration) for section in kept)
+        if (prompt_tokens <= prompt_budget and output_tokens <= output_budget) or not trim:
+            return prompt
+        dropped = trim.pop(0)
+        kept = [section for section in kept if section.name != dropped]
+        print(f"Itinerary request over budget ({prompt_tokens} prompt, ~{output_tokens} output tokens); "
+              f"dropping {dropped}")  # Debug log
+
+
+# 'stream' generates the itinerary in one streamed call; 'parallel' generates
+# its sections concurrently and stitches them together in order
+ITINERARY_MODE = os.getenv('ITINERARY_MODE', 'stream')
+# Upper bound on separate day-by-day prompts in parallel mode
+MAX_DAY_SECTIONS = int(os.getenv('MAX_DAY_SECTIONS', 7))
+ITINERARY_FAILED = "I apologize, but I couldn't generate the itinerary. Please try again."
+SECTION_FAILED = "_This section could not be generated. Please try again._"
+SECTION_TIMED_OUT = "_This section ran out of time. Please try again for the full plan._"
+ITINERARY_CUT_SHORT = "_Gemini stopped before finishing this itinerary. Please try again for the full plan._"
+ITINERARY_TIMED_OUT = ("_Gemini ran out of time on this itinerary, so here is a basic outline to start from. "
+                       "Please try again for a detailed plan._")
+
+# Preference fields each section depends on; a section is only regenerated
+# when one of its fields changes
+SECTION_FIELDS = {
+    'travel': ['starting_location', 'destination', 'budget', 'mobility_concerns'],
+    'days': ['destination', 'duration', 'purpose', 'preferences', 'budget', 'mobility_concerns'],
+    'accommodation': ['destination', 'budget', 'accommodation_preferences', 'mobility_concerns'],
+    'experiences': ['destination', 'purpose', 'preferences', 'dietary_restrictions'],
+    'practical': ['destination', 'duration', 'budget', 'mobility_concerns'],
+}
+
+
+class Itinerary:
+    """Generated itinerary sections with fingerprints of the preferences they used"""
+
+    def __init__(self):
+        self.sections = {}  # heading -> (fingerprint, text)
+
+    def get(self, heading, fingerprint):
+        """Return a stored section if it was generated from the same preferences"""
+        stored = self.sections.get(heading)
+        if stored and stored[0] == fingerprint:
+            return stored[1]
+        return None
+
+    def set(self, heading, fingerprint, text):
+        self.sections[heading] = (fingerprint, text)
+
+    def to_dict(self):
+        return {heading: list(section) for heading, section in self.sections.items()}
+
+    @classmethod
+    def from_dict(cls, data):
+        itinerary = cls()
+        itinerary.sections = {heading: tuple(section) for heading, section in data.items()}
+        return itinerary
+
+
+def section_fingerprint(preferences, fields):
+    """Hash the preference values a section depends on"""
+    values = json.dumps([preferences.get(f) for f in fields], sort_keys=True, default=str)
+    return hashlib.sha256(values.encode('utf-8')).hexdigest()[:16]
+
+def build_section_prompts(preferences):
+    """Split the itinerary into independent (heading, prompt, fingerprint) entries in document order"""
+    duration = int(preferences['duration'])
+    descriptions = {section.name: f"{section.title}: {section.description}" for section in ITINERARY_SECTIONS}
+    sections = [('travel', "## 1. Travel Plan", descriptions['travel'])]
+
+    # Spread the days over at most MAX_DAY_SECTIONS prompts
+    days_per_section = -(-duration // MAX_DAY_SECTIONS)
+    for first in range(1, duration + 1, days_per_section):
+        last = min(first + days_per_section - 1, duration)
+        days = f"Day {first}" if first == last else f"Days {first}-{last}"
+        heading = "## 2. Day-by-Day Itinerary\n\n" if first == 1 else ""
+        arrival = "Day 1 is the travel and arrival day. " if first == 1 else ""
+        sections.append(('days', f"{heading}### {days}", f"{days} of the day-by-day itinerary only. "
+                         f"{arrival}Daily activities tailored to the trip purpose, with flexible timing"))
+
+    sections += [
+        ('accommodation', "## 3. Accommodation", descriptions['accommodation']),
+        ('experiences', "## 4. Local Experiences", descriptions['experiences']),
+        ('practical', "## 5. Practical Information", descriptions['practical']),
+    ]
+
+    prompts = []
+    for kind, heading, instructions in sections:
+        fields = SECTION_FIELDS[kind]
+        prompt = SECTION_PROMPT.render(
+            duration=duration, details=format_trip_details(preferences, fields), instructions=instructions
+        )
+        prompts.append((heading, prompt, section_fingerprint(preferences, fields)))
+    return prompts
+
+def iter_itinerary_sections(preferences, route, engine, previous=None, deadline=None):
+    """Generate sections concurrently and yield (heading, text, fingerprint) in document order
+
+    Sections of the previous Itinerary whose preference fields are unchanged
+    are reused instead of being regenerated. All sections share one deadline.
+    """
+    deadline = deadline or route.deadline()
+    sections = build_section_prompts(preferences)
+    futures = []
+    for heading, prompt, fingerprint in sections:
+        reused = previous.get(heading, fingerprint) if previous else None
+        if reused is None:
+            reused = engine.executor.submit(route.generate, engine, prompt, True, deadline)
+        futures.append(reused)
+    for (heading, prompt, fingerprint), future in zip(sections, futures):
+        if isinstance(future, str):
+            yield heading, future, fingerprint
+            continue
+        text = future.result()
+        if text is None and not deadline.expired():
+            # Retry only the section that failed
+            text = route.generate(engine, prompt, deadline=deadline)
+        yield heading, text, fingerprint
+
+def iter_itinerary_parts(preferences, route, engine, previous, itinerary, deadline=None):
+    """Yield formatted sections in order, recording them in itinerary for incremental regeneration"""
+    deadline = deadline or route.deadline()
+    generated = False
+    for heading, text, fingerprint in iter_itinerary_sections(preferences, route, engine, previous, deadline):
+        if text is None:
+            text = SECTION_TIMED_OUT if deadline.expired() else SECTION_FAILED
+        else:
+            generated = True
+            itinerary.set(heading, fingerprint, text)
+        yield f"{heading}\n\n{text}\n\n"
+    if not generated:
+        raise RuntimeError("No itinerary section could be generated")
+
+def build_itinerary_outline(preferences):
+    """A plain day-by-day outline built without the model, shown when it runs out of time"""
+    duration = int(preferences.get('duration') or 1)
+    destination = preferences.get('destination') or 'your destination'
+    lines = [ITINERARY_TIMED_OUT, "", "## Trip Overview", "", format_trip_details(preferences), "",
+             "## Day-by-Day Outline", ""]
+    for day in range(1, duration + 1):
+        if day == 1:
+            plan = f"Travel to {destination}, check in and explore nearby"
+        elif day == duration:
+            plan = "Last sights and souvenirs, then the journey home"
+        else:
+            plan = f"Explore {destination}: {format_prompt_value(preferences.get('preferences') or 'local highlights')}"
+        lines.append(f"- **Day {day}:** {plan}")
+    return '\n'.join(lines)
+
+def generate_itinerary_parallel(preferences, deadline=None):
+    """Generate the itinerary section by section; returns None if every section failed"""
+    itinerary = Itinerary()
+    try:
+        parts = iter_itinerary_parts(
+            preferences, resolve_route('itinerary_section'), get_engine(), st.session_state.itinerary, itinerary,
+            deadline
+        )
+        text = ''.join(parts).strip()
+    except RuntimeError as e:
+        print(str(e))
+        return None
+    st.session_state.itinerary = itinerary
+    return text
+
+def generate_itinerary(preferences):
+    """Generate a detailed travel itinerary based on preferences"""
     try:
-        response = get_ai_response(prompt)
+        if ITINERARY_MODE == 'parallel':
+            deadline = task_deadline('itinerary_section')
+            response = generate_itinerary_parallel(preferences, deadline)
+        else:
+            deadline = task_deadline('itinerary')
+            response = get_ai_response(build_itinerary_prompt(preferences), task='itinerary', deadline=deadline)
         if response:
             return response
+        elif deadline.expired():
+            return build_itinerary_outline(preferences)
         else:
-            return "I apologize, but I couldn't generate the itinerary. Please try again."
+            return ITINERARY_FAILED
     except Exception as e:
         print(f"Error generating itinerary: {str(e)}")
         return "Sorry, there was an error generating your itinerary. Please try again."
 
+# Background itinerary workers; ITINERARY_WORKERS caps concurrent generations per server
+ITINERARY_WORKERS = int(os.getenv('ITINERARY_WORKERS', 2))
+# SQLite file where finished itineraries are kept across reruns and restarts
+ITINERARY_STORE = os.getenv('ITINERARY_STORE', 'itineraries.db')
+# Seconds before a queued or running itinerary job is considered abandoned
+ITINERARY_JOB_TIMEOUT = float(os.getenv('ITINERARY_JOB_TIMEOUT', 180))
+# Seconds a finished itinerary is reused; the prompts ask for current conditions
+ITINERARY_TTL = int(os.getenv('ITINERARY_TTL', CACHE_TTL))
+MAX_ITINERARY_JOBS = 100
+MAX_STORED_ITINERARIES = 1000
+
+
+class ItineraryJob:
+    """One itinerary generation for a preference fingerprint"""
+
+    PENDING = 'pending'
+    RUNNING = 'running'
+    DONE = 'done'
+    FAILED = 'failed'
+
+    def __init__(self, key):
+        self.key = key
+        self.state = self.PENDING
+        self.result = None
+        self.error = None
+        self.sections = None  # Itinerary for incremental regeneration, in parallel mode
+        self.degraded = False  # Incomplete: cut short, missing sections or an outline; never reused
+        self.finished_at = None
+        self.chunks = []
+        self.started = time.monotonic()
+        self.finished = threading.Event()
+        self.lock = threading.Lock()
+
+    def start(self):
+        self.state = self.RUNNING
+        self.started = time.monotonic()
+
+    def append(self, chunk):
+        with self.lock:
+            self.chunks.append(chunk)
+
+    def text(self):
+        """Text generated so far"""
+        with self.lock:
+            return ''.join(self.chunks)
+
+    def finish(self, result, finished_at=None):
+        self.result = result
+        self.state = self.DONE
+        self.finished_at = finished_at or time.time()
+        self.finished.set()
+
+    def fail(self, error):
+        self.error = str(error)
+        self.state = self.FAILED
+        self.finished.set()
+
+    def wait(self, timeout=ITINERARY_JOB_TIMEOUT):
+        """Block until the job finishes; returns False on timeout"""
+        return self.finished.wait(timeout)
+
+    def is_stale(self):
+        return self.state in (self.PENDING, self.RUNNING) and time.monotonic() - self.started > ITINERARY_JOB_TIMEOUT
+
+    def is_expired(self, ttl=ITINERARY_TTL):
+        return self.state == self.DONE and time.time() - self.finished_at > ttl
+
+    def reusable(self):
+        """Whether a request for the same preferences can join or reuse this job"""
+        return self.state != self.FAILED and not self.degraded and not self.is_stale() and not self.is_expired()
+
+
+class ItineraryStore:
+    """Persists complete itineraries in SQLite so any worker can serve them until they expire"""
+
+    def __init__(self, path=ITINERARY_STORE, max_entries=MAX_STORED_ITINERARIES, ttl=ITINERARY_TTL):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS itineraries (key TEXT PRIMARY KEY, result TEXT, updated REAL)"
+        )
+        self.conn.commit()
+
+    def save(self, job):
+        now = time.time()
+        with self.lock:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO itineraries VALUES (?, ?, ?)", (job.key, job.result, job.finished_at)
+            )
+            # Drop expired rows, then the oldest beyond the size limit
+            self.conn.execute("DELETE FROM itineraries WHERE updated < ?", (now - self.ttl,))
+            self.conn.execute(
+                "DELETE FROM itineraries WHERE key NOT IN "
+                "(SELECT key FROM itineraries ORDER BY updated DESC LIMIT ?)",
+                (self.max_entries,)
+            )
+            self.conn.commit()
+
+    def load(self, key):
+        """Return a finished job for the key, or None if there is none or it expired"""
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT result, updated FROM itineraries WHERE key = ? AND updated >= ?",
+                (key, time.time() - self.ttl)
+            ).fetchone()
+        if row is None:
+            return None
+        job = ItineraryJob(key)
+        job.append(row[0])
+        job.finish(row[0], finished_at=row[1])
+        return job
+
+
+def finish_degraded(job, preferences):
+    """Finish a job that ran out of time or was cut short with what it has, or a local outline if it has nothing"""
+    if job.sections is not None:
+        generated = bool(job.sections.sections)
+    else:
+        generated = bool(job.text().strip())
+    if generated:
+        job.append(f"\n\n{ITINERARY_CUT_SHORT}")
+    else:
+        job.append(f"\n\n{build_itinerary_outline(preferences)}")
+    job.degraded = True
+    job.finish(job.text().strip())
+
+def run_itinerary_job(job, preferences, route, engine, previous=None):
+    """Generate an itinerary on a background worker, publishing partial text on the job"""
+    job.start()
+    # The budget starts when a worker picks the job up, not while it waits in the queue
+    deadline = route.deadline()
+    try:
+        if ITINERARY_MODE == 'parallel':
+            job.sections = Itinerary()
+            chunks = iter_itinerary_parts(preferences, route, engine, previous, job.sections, deadline)
+        else:
+            chunks = route.stream(engine, build_itinerary_prompt(preferences), deadline=deadline)
+        for chunk in chunks:
+            job.append(chunk)
+        if deadline.expired():
+            finish_degraded(job, preferences)
+            return
+        itinerary = job.text().strip()
+        if job.sections is not None and len(job.sections.sections) < len(build_section_prompts(preferences)):
+            job.degraded = True  # Some sections failed and show a placeholder
+        if itinerary:
+            job.finish(itinerary)
+        else:
+            job.fail("Itinerary generation failed")
+    except StreamInterrupted as e:
+        print(str(e))
+        finish_degraded(job, preferences)
+    except Exception as e:
+        print(f"Error generating itinerary: {str(e)}")
+        if deadline.expired():
+            finish_degraded(job, preferences)
+        else:
+            job.fail(e)
+
+
+class ItineraryJobs:
+    """Single-flight itinerary jobs run on a background worker pool
+
+    The backend is anything with an Executor-style submit(); jobs keep
+    running when the Streamlit script that queued them is rerun or stopped.
+    """
+
+    def __init__(self, backend, store=None, max_jobs=MAX_ITINERARY_JOBS):
+        self.backend = backend
+        self.store = store
+        self.max_jobs = max_jobs
+        self.jobs = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        """Return the job for a key, falling back to persisted results"""
+        with self.lock:
+            job = self.jobs.get(key)
+        if job is None and self.store is not None:
+            job = self.store.load(key)
+        return job
+
+    def submit(self, key, *args):
+        """Queue a job for the key unless an identical one is queued, running or done"""
+        with self.lock:
+            job = self.jobs.get(key)
+            if job is None and self.store is not None:
+                job = self.store.load(key)
+            if job is not None and job.reusable():
+                self.jobs[key] = job
+                self.jobs.move_to_end(key)
+                return job
+            job = ItineraryJob(key)
+            self.jobs[key] = job
+            while len(self.jobs) > self.max_jobs:
+                self.jobs.popitem(last=False)
+        self.backend.submit(self.run, job, *args)
+        return job
+
+    def run(self, job, *args):
+        run_itinerary_job(job, *args)
+        # Only complete itineraries are kept; incomplete ones are shown once and the next request retries
+        if job.state == ItineraryJob.DONE and not job.degraded and self.store is not None:
+            self.store.save(job)
+
+
+@st.cache_resource(show_spinner=False)
+def get_itinerary_jobs():
+    """Return the process-wide itinerary job queue"""
+    workers = ThreadPoolExecutor(max_workers=ITINERARY_WORKERS, thread_name_prefix='itinerary')
+    return ItineraryJobs(workers, ItineraryStore())
+
+
+def itinerary_fingerprint(preferences):
+    """Key identifying an itinerary by model, generation mode and preferences"""
+    payload = json.dumps([ITINERARY_MODEL, ITINERARY_MODE, preferences.to_json()])
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+def follow_job(job, poll_interval=0.2):
+    """Yield a job's new text as it arrives until the job finishes"""
+    sent = 0
+    while True:
+        finished = job.finished.is_set()
+        text = job.text()
+        if len(text) > sent:
+            yield text[sent:]
+            sent = len(text)
+        if finished:
+            return
+        job.finished.wait(poll_interval)
+
+def create_itinerary(preferences):
+    """Queue the itinerary for these preferences; main() shows it via await_itinerary()
+
+    Both the chat keyword and the button use this, so repeated requests and
+    reruns join the queued or running job or reuse the finished one.
+    """
+    route = resolve_route('itinerary_section' if ITINERARY_MODE == 'parallel' else 'itinerary')
+    job = get_itinerary_jobs().submit(
+        itinerary_fingerprint(preferences), preferences.copy(), route, get_engine(), st.session_state.itinerary
+    )
+    st.session_state.itinerary_job = job.key
+    return job
+
+def await_itinerary():
+    """Show this session's itinerary job and add the result to the chat once it is done"""
+    key = st.session_state.itinerary_job
+    job = get_itinerary_jobs().get(key) if key else None
+    if job is None:
+        st.session_state.itinerary_job = None
+        return None
+
+    st.subheader("Your Personalized Travel Itinerary")
+    status = st.empty()
+    status.caption(f"Itinerary status: {job.state}")
+    # A rerun may stop the script here; the job keeps running and the next run resumes it
+    st.write_stream(follow_job(job))
+    st.session_state.itinerary_job = None
+    status.caption(f"Itinerary status: {job.state}")
+    if job.state != ItineraryJob.DONE:
+        report_failure()
+        return None
+    if job.degraded:
+        report_timeout('itinerary')
+
+    if job.sections is not None:
+        st.session_state.itinerary = job.sections
+    record_first_itinerary()
+    destination = st.session_state.user_preferences['destination']
+    add_message("assistant", f"Here's your personalized itinerary for {destination}:\n\n{job.result}")
+    return job.result
+
+# Chat history budget per session; older turns are folded into a rolling summary
+HISTORY_MAX_MESSAGES = int(os.getenv('HISTORY_MAX_MESSAGES', 40))
+HISTORY_MAX_BYTES = int(os.getenv('HISTORY_MAX_BYTES', 32768))
+HISTORY_SUMMARY_CHARS = 2000
+# Messages longer than this are kept in the blob store and referenced by ID
+BLOB_THRESHOLD = 2000
+BLOB_STORE = os.getenv('BLOB_STORE', 'blobs.db')
+
+
+class BlobStore:
+    """Content-addressed SQLite store for large chat messages such as itineraries"""
+
+    def __init__(self, path=BLOB_STORE):
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute("CREATE TABLE IF NOT EXISTS blobs (id TEXT PRIMARY KEY, content TEXT)")
+        self.conn.commit()
+
+    def put(self, content):
+        blob_id = hashlib.sha256(content.encode('utf-8')).hexdigest()[:32]
+        with self.lock:
+            self.conn.execute("INSERT OR IGNORE INTO blobs VALUES (?, ?)", (blob_id, content))
+            self.conn.commit()
+        return blob_id
+
+    def get(self, blob_id):
+        with self.lock:
+            row = self.conn.execute("SELECT content FROM blobs WHERE id = ?", (blob_id,)).fetchone()
+        return row[0] if row else None
+
+
+@st.cache_resource(show_spinner=False)
+def get_blob_store():
+    """Return the process-wide blob store"""
+    return BlobStore()
+
+
+def message_content(message):
+    """Full text of a chat message, loading it from the blob store if needed"""
+    if 'blob' in message:
+        return get_blob_store().get(message['blob']) or message['content']
+    return message['content']
+
+def message_size(message):
+    return len(message['content'].encode('utf-8'))
+
+def summarize_messages(messages):
+    """Compact messages into one line each for the rolling summary"""
+    lines = []
+    for message in messages:
+        speaker = "User" if message["role"] == "user" else "Assistant"
+        text = ' '.join(message["content"].split())
+        lines.append(f"{speaker}: {text[:120]}{'...' if len(text) > 120 else ''}")
+    return '\n'.join(lines)
+
+def add_message(role, content):
+    """Append a chat message, offloading large ones and compacting the oldest when over budget"""
+    message = {"role": role, "content": content}
+    if len(content) > BLOB_THRESHOLD:
+        message["blob"] = get_blob_store().put(content)
+        message["content"] = content.split('\n', 1)[0]
+    history = st.session_state.chat_history
+    history.append(message)
+
+    compacted = []
+    while len(history) > 1 and (
+        len(history) > HISTORY_MAX_MESSAGES or sum(message_size(m) for m in history) > HISTORY_MAX_BYTES
+    ):
+        compacted.append(history.pop(0))
+    if compacted:
+        summary = '\n'.join(filter(None, [st.session_state.history_summary, summarize_messages(compacted)]))
+        # Keep the most recent part of the summary within its budget
+        st.session_state.history_summary = summary[-HISTORY_SUMMARY_CHARS:]
+    print(f"Chat history: {history_stats()}")  # Debug log
+
+def history_stats():
+    """Memory held by this session's chat history"""
+    history = st.session_state.chat_history
+    return {
+        'messages': len(history),
+        'bytes': sum(message_size(m) for m in history),
+        'summary_bytes': len(st.session_state.history_summary.encode('utf-8')),
+        'blobs': sum(1 for m in history if 'blob' in m),
+    }
+
+# SQLite file holding conversations so they survive restarts and work across replicas
+SESSION_STORE = os.getenv('SESSION_STORE', 'sessions.db')
+
+
+class SessionStore:
+    """Persists session state as one row per key, keyed by session ID"""
+
+    def __init__(self, path=SESSION_STORE):
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS session_state "
+            "(session_id TEXT, key TEXT, value TEXT, updated REAL, PRIMARY KEY (session_id, key))"
+        )
+        self.conn.commit()
+
+    def load(self, session_id):
+        """Return {key: serialized value} for a session"""
+        with self.lock:
+            rows = self.conn.execute(
+                "SELECT key, value FROM session_state WHERE session_id = ?", (session_id,)
+            ).fetchall()
+        return dict(rows)
+
+    def save(self, session_id, values):
+        """Write only the given serialized values"""
+        now = time.time()
+        with self.lock:
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO session_state VALUES (?, ?, ?, ?)",
+                [(session_id, key, value, now) for key, value in values.items()]
+            )
+            self.conn.commit()
+
+
+@st.cache_resource(show_spinner=False)
+def get_session_store():
+    """Return the process-wide session store"""
+    return SessionStore()
+
+
+# Session state keys that are persisted, with (serialize, deserialize) functions.
+# The model is not persisted; every process attaches the shared client itself.
+PERSISTED_KEYS = {
+    'chat_history': (list, list),
+    'history_summary': (str, str),
+    'user_preferences': (lambda p: p.to_dict(), lambda d: TravelPreferences.from_dict(d)),
+    'last_input': (None, None),
+    'asked_questions': (sorted, set),
+    'pending_field': (None, None),
+    'itinerary': (lambda i: i and i.to_dict(), lambda d: d and Itinerary.from_dict(d)),
+    'itinerary_job': (None, None),
+    'turn_count': (None, None),
+    'turns_to_itinerary': (None, None),
+}
+
+def serialize_state(key):
+    dump = PERSISTED_KEYS[key][0] or (lambda value: value)
+    return json.dumps(dump(st.session_state[key]), sort_keys=True, ensure_ascii=False)
+
+def restore_session():
+    """Attach this browser session to its persisted state, creating an ID on first visit
+
+    The ID lives in the page URL, so a reconnect to any replica finds the
+    same conversation without sticky sessions.
+    """
+    session_id = st.query_params.get('session')
+    if not session_id:
+        session_id = uuid.uuid4().hex
+        st.query_params['session'] = session_id
+    st.session_state.session_id = session_id
+
+    stored = get_session_store().load(session_id)
+    for key, raw in stored.items():
+        if key in PERSISTED_KEYS:
+            load = PERSISTED_KEYS[key][1] or (lambda value: value)
+            st.session_state[key] = load(json.loads(raw))
+    st.session_state.persisted = stored
+
+def save_session():
+    """Write the persisted keys that changed since the last save"""
+    changed = {}
+    for key in PERSISTED_KEYS:
+        raw = serialize_state(key)
+        if st.session_state.persisted.get(key) != raw:
+            changed[key] = raw
+    if changed:
+        get_session_store().save(st.session_state.session_id, changed)
+        st.session_state.persisted.update(changed)
+
+# Number of most recent chat messages rendered in full on every rerun
+CHAT_WINDOW = int(os.getenv('CHAT_WINDOW', 10))
+# Assistant messages longer than this (itineraries) are collapsed unless they are the latest
+LONG_MESSAGE_CHARS = 1500
+
+@st.cache_data(max_entries=512, show_spinner=False)
+def format_message(role, content):
+    """Return (summary, markdown) for a chat message; memoized across reruns"""
+    speaker = "You" if role == "user" else "Assistant"
+    summary = content.split('\n', 1)[0].strip()
+    if len(summary) > 80:
+        summary = summary[:77] + "..."
+    return f"{speaker}: {summary}", f"{speaker}: {content}"
+
+def render_message(message, collapse):
+    content = message_content(message)
+    summary, markdown = format_message(message["role"], content)
+    if collapse and message["role"] != "user" and len(content) > LONG_MESSAGE_CHARS:
+        with st.expander(summary):
+            st.write(markdown)
+    else:
+        st.write(markdown)
+
+def render_chat_history(history):
+    """Render the latest CHAT_WINDOW messages; older ones only when asked for"""
+    older = history[:-CHAT_WINDOW] if len(history) > CHAT_WINDOW else []
+    recent = history[len(older):]
+    if st.session_state.history_summary:
+        with st.expander("Earlier conversation (summary)"):
+            st.text(st.session_state.history_summary)
+    if older and st.toggle(f"Show {len(older)} earlier messages", key="show_earlier_messages"):
+        for message in older:
+            render_message(message, collapse=True)
+    for i, message in enumerate(recent):
+        render_message(message, collapse=i < len(recent) - 1)
+
+def render_debug_panel():
+    """Show recent model calls and engine state"""
+    metrics = get_metrics()
+    with st.expander("Debug: model calls"):
+        memory = metrics.sink('memory')
+        if memory is not None:
+            st.json(memory.recent(), expanded=False)
+        prometheus = metrics.sink('prometheus')
+        if prometheus is not None:
+            st.code(prometheus.render(), language='text')
+        st.json(get_engine().status())
+
+def request_itinerary():
+    """Button callback: queue the itinerary before the script runs"""
+    add_message("assistant", "I'll create your itinerary now...")
+    create_itinerary(st.session_state.user_preferences)
+
+def handle_user_input():
+    """Chat input callback: process the message before the script runs, so one turn is one run"""
+    user_input = st.session_state.user_input
+    if not user_input:
+        return
+
+    # Update last input
+    st.session_state.last_input = user_input
+    st.session_state.turn_count += 1
+    st.session_state.turn_runs = 0
+
+    # Add user message to chat history
+    add_message("user", user_input)
+
+    # Check if user wants itinerary
+    if any(word in user_input.lower() for word in ["itinerary", "plan", "create", "generate", "show"]):
+        if st.session_state.user_preferences.is_ready():
+            request_itinerary()
+        else:
+            missing = [k.replace('_', ' ').title() for k in st.session_state.user_preferences.missing_essentials()]
+            add_message("assistant", f"I still need some essential information before I can create your itinerary: {', '.join(missing)}")
+    else:
+        # Extract preferences from user input
+        next_question = None
+        if TURN_PIPELINE:
+            extracted_prefs, next_question = run_turn(
+                user_input, st.session_state.user_preferences, st.session_state.pending_field,
+                st.session_state.asked_questions
+            )
+        else:
+            extracted_prefs = extract_preferences(
+                user_input, st.session_state.user_preferences, st.session_state.pending_field
+            )
+        merge_preferences(st.session_state.user_preferences, extracted_prefs)
+
+        unasked = get_unasked_fields(st.session_state.user_preferences, st.session_state.asked_questions)
+        if next_question and unasked:
+            # The model's question covers every field still worth asking about at once; essentials
+            # stay unmarked so get_next_question() can still ask for them one by one
+            st.session_state.asked_questions.update(f for f in unasked if f not in ESSENTIAL_FIELDS)
+            st.session_state.pending_field = unasked[0] if len(unasked) == 1 else None
+        else:
+            # Get next question based on missing information
+            next_question = get_next_question(st.session_state.user_preferences)
+        
+        if next_question:
+            add_message("assistant", next_question)
+        elif st.session_state.user_preferences.is_ready():
+            destination = st.session_state.user_preferences['destination']
+            add_message("assistant", f"Great! I have all the essential information about your trip to {destination}. Type 'create itinerary' and I'll generate a detailed plan for you.")
+
 def main():
     st.title("AI Travel Planner")
+
+    # Restore a persisted conversation the first time this session runs here
+    if 'session_id' not in st.session_state:
+        restore_session()
+
+    st.session_state.script_runs += 1
+    st.session_state.turn_runs += 1
+    print(f"Script run {st.session_state.script_runs}, {st.session_state.turn_runs} this turn")  # Debug log
     
     # Initialize Gemini at the start
     if 'model' not in st.session_state:
@@ -226,64 +2609,15 @@ def main():
     st.write("Hi there! 👋 I'm your friendly AI travel assistant. I'm here to help you plan a wonderful and rejuvenating trip. Let's create an experience that brings you joy and peace.")
 
     # Display chat history
-    for message in st.session_state.chat_history:
-        if message["role"] == "user":
-            st.write(f"You: {message['content']}")
-        else:
-            st.write(f"Assistant: {message['content']}")
+    render_chat_history(st.session_state.chat_history)
 
-    # User input
-    user_input = st.text_input("Tell me about your travel plans:", key="user_input")
-    
-    if user_input and user_input != st.session_state.last_input:
-        # Update last input
-        st.session_state.last_input = user_input
-        
-        # Add user message to chat history
-        st.session_state.chat_history.append({"role": "user", "content": user_input})
-        
-        # Check if user wants itinerary
-        if any(word in user_input.lower() for word in ["itinerary", "plan", "create", "generate", "show"]):
-            if all(st.session_state.user_preferences[k] is not None for k in ['budget', 'duration', 'destination', 'starting_location']):
-                st.session_state.chat_history.append({
-                    "role": "assistant",
-                    "content": "I'll create your itinerary now..."
-                })
-                itinerary = generate_itinerary(st.session_state.user_preferences)
-                if itinerary:
-                    st.session_state.chat_history.append({
-                        "role": "assistant",
-                        "content": f"Here's your personalized itinerary for {st.session_state.user_preferences['destination']}:\n\n{itinerary}"
-                    })
-            else:
-                missing = [k.replace('_', ' ').title() for k in ['budget', 'duration', 'destination', 'starting_location'] 
-                          if st.session_state.user_preferences[k] is None]
-                st.session_state.chat_history.append({
-                    "role": "assistant",
-                    "content": f"I still need some essential information before I can create your itinerary: {', '.join(missing)}"
-                })
-        else:
-            # Extract preferences from user input
-            extracted_prefs = extract_preferences(user_input)
-            if extracted_prefs:
-                # Update user preferences
-                for key, value in extracted_prefs.items():
-                    if value is not None:
-                        st.session_state.user_preferences[key] = value
-            
-            # Get next question based on missing information
-            next_question = get_next_question(st.session_state.user_preferences)
-            
-            if next_question:
-                st.session_state.chat_history.append({"role": "assistant", "content": next_question})
-            elif all(v is not None for v in [st.session_state.user_preferences[k] for k in ['budget', 'duration', 'destination', 'starting_location']]):
-                destination = st.session_state.user_preferences['destination']
-                st.session_state.chat_history.append({
-                    "role": "assistant", 
-                    "content": f"Great! I have all the essential information about your trip to {destination}. Type 'create itinerary' and I'll generate a detailed plan for you."
-                })
-        
-        st.rerun()
+    # Show an itinerary queued this turn, or resume one a rerun interrupted
+    if st.session_state.itinerary_job:
+        save_session()  # Following the job can take a while; persist the turn first
+        await_itinerary()
+
+    # User input; handled in the callback before this run started
+    st.chat_input("Tell me about your travel plans:", key="user_input", on_submit=handle_user_input)
 
     # Display current preferences
     if any(st.session_state.user_preferences.values()):
@@ -296,20 +2630,13 @@ def main():
                     st.write(f"{key.replace('_', ' ').title()}: {value}")
 
     # Generate itinerary button
-    if all(v is not None for v in [st.session_state.user_preferences[k] for k in ['budget', 'duration', 'destination', 'starting_location']]):
-        if st.button("Generate Travel Itinerary"):
-            st.session_state.chat_history.append({
-                "role": "assistant",
-                "content": "I'll create your itinerary now..."
-            })
-            itinerary = generate_itinerary(st.session_state.user_preferences)
-            if itinerary:
-                st.subheader("Your Personalized Travel Itinerary")
-                st.write(itinerary)
-                st.session_state.chat_history.append({
-                    "role": "assistant",
-                    "content": f"Here's your personalized itinerary for {st.session_state.user_preferences['destination']}:\n\n{itinerary}"
-                })
+    if st.session_state.user_preferences.is_ready():
+        st.button("Generate Travel Itinerary", on_click=request_itinerary)
+
+    if DEBUG_PANEL:
+        render_debug_panel()
+
+    save_session()
 
 if __name__ == "__main__":
     main() 
\ No newline at end of file
@@ -0,0 +1,323 @@
+"""Benchmarks for the travel planner against a deterministic fake Gemini backend
+
+Run with:
+    python benchmark.py --output bench_output.json
+
+No API key or network access is needed. The fake model replaces
+genai.GenerativeModel, so every code path in app.py runs unchanged.
+"""
+import argparse
+import contextlib
+import json
+import os
+import random
+import statistics
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from types import SimpleNamespace
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+APP_PATH = os.path.join(ROOT, 'app.py')
+
+CANNED_EXTRACTION = {
+    'budget': 'mid-range',
+    'duration': 5,
+    'destination': 'Goa',
+    'starting_location': 'Delhi',
+    'purpose': 'relaxation',
+    'preferences': ['beaches', 'local food'],
+}
+CANNED_QUESTION = "Lovely! What kind of stay would you like, and any dietary needs?"
+CONVERSATION = [
+    "I want a relaxing beach holiday somewhere warm, maybe Goa",
+    "from Delhi",
+    "5 days",
+    "mid-range",
+    "create itinerary",
+]
+
+
+class FakeConfig:
+    """Latency, throughput and error settings for the fake model"""
+
+    def __init__(self, latency_ms=300, jitter_ms=100, tokens_per_sec=200, itinerary_tokens=1200,
+                 error_rate=0.0, seed=42):
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.tokens_per_sec = tokens_per_sec
+        self.itinerary_tokens = itinerary_tokens
+        self.error_rate = error_rate
+        self.seed = seed
+
+    def to_dict(self):
+        return dict(vars(self))
+
+
+class FakeResponse:
+    """Mimics the parts of GenerateContentResponse the app reads"""
+
+    def __init__(self, text, prompt_tokens):
+        self.text = text
+        self.usage_metadata = SimpleNamespace(
+            prompt_token_count=prompt_tokens,
+            candidates_token_count=max(1, len(text) // 4),
+            total_token_count=prompt_tokens + max(1, len(text) // 4),
+        )
+
+
+class FakeGenerativeModel:
+    """Deterministic stand-in for genai.GenerativeModel
+
+    Each call draws its latency and failure from a generator seeded by the
+    run seed, the request and how often that request was seen before, so the
+    draws do not depend on how concurrent callers are scheduled.
+    """
+
+    config = FakeConfig()
+    seen = {}
+    lock = threading.Lock()
+
+    def __init__(self, model_name='gemini-2.0-flash', system_instruction=None, **kwargs):
+        self.model_name = model_name
+        self.system_instruction = system_instruction or ''
+
+    @classmethod
+    def configure(cls, config):
+        cls.config = config
+        cls.seen = {}
+
+    def sample(self, contents):
+        """Draw (first byte delay in seconds, whether this call fails)"""
+        key = f"{self.config.seed}:{self.model_name}:{self.system_instruction}:{contents}"
+        with self.lock:
+            self.seen[key] = attempt = self.seen.get(key, 0) + 1
+        rng = random.Random(f"{key}:{attempt}")
+        delay = max(0.0, rng.gauss(self.config.latency_ms, self.config.jitter_ms)) / 1000
+        failed = rng.random() < self.config.error_rate
+        return delay, failed
+
+    def reply(self, prompt):
+        prompt = str(prompt)
+        instruction = self.system_instruction
+        if '"next_question"' in instruction:
+            return json.dumps({'patch': CANNED_EXTRACTION, 'next_question': CANNED_QUESTION})
+        if 'JSON object' in instruction:
+            return json.dumps(CANNED_EXTRACTION)
+        if prompt == 'Hi':
+            return 'Hello!'
+        words = ["Explore", "the", "beach", "at", "sunrise,", "then", "enjoy", "local", "seafood."]
+        return ' '.join(words[i % len(words)] for i in range(self.config.itinerary_tokens))
+
+    def generate_content(self, contents, stream=False, **kwargs):
+        from google.api_core import exceptions as google_exceptions
+
+        delay, failed = self.sample(contents)
+        time.sleep(delay)
+        if failed:
+            raise google_exceptions.ServiceUnavailable("Fake upstream error")
+        text = self.reply(contents)
+        prompt_tokens = max(1, len(self.system_instruction + str(contents)) // 4)
+        tokens = text.split(' ')
+        if not stream:
+            time.sleep(len(tokens) / self.config.tokens_per_sec)
+            return FakeResponse(text, prompt_tokens)
+        return self.stream(tokens, prompt_tokens)
+
+    def stream(self, tokens, prompt_tokens, chunk_tokens=20):
+        for start in range(0, len(tokens), chunk_tokens):
+            chunk = tokens[start:start + chunk_tokens]
+            time.sleep(len(chunk) / self.config.tokens_per_sec)
+            yield FakeResponse(' '.join(chunk) + ' ', prompt_tokens)
+
+
+def install_fake(config):
+    """Route all model construction in app.py through the fake"""
+    import google.generativeai as genai
+
+    FakeGenerativeModel.configure(config)
+    genai.GenerativeModel = FakeGenerativeModel
+    genai.configure = lambda **kwargs: None
+
+
+def prepare_environment(workdir):
+    """Keep benchmark state out of the working tree and turn off response and itinerary caching
+
+    The engine, response cache and itinerary jobs are process-wide, so without
+    this later runs would be served from what earlier runs generated.
+    """
+    os.environ.setdefault('GOOGLE_API_KEY', 'benchmark')
+    os.environ['CACHE_BACKEND'] = 'memory'
+    os.environ['CACHE_MAX_ENTRIES'] = '0'
+    os.environ['ITINERARY_TTL'] = '0'
+    os.environ['RATE_LIMIT_RPM'] = '100000'
+    os.environ['RATE_LIMIT_TPM'] = '1000000000'
+    for name, filename in [('ITINERARY_STORE', 'itineraries.db'), ('BLOB_STORE', 'blobs.db'),
+                           ('SESSION_STORE', 'sessions.db')]:
+        os.environ[name] = os.path.join(workdir, filename)
+
+
+def load_app():
+    """Import app.py outside the Streamlit runtime and return its namespace"""
+    import logging
+    import runpy
+
+    logging.getLogger('streamlit').setLevel(logging.ERROR)
+    return runpy.run_path(APP_PATH)
+
+
+def summarize(samples):
+    """Latency summary in milliseconds"""
+    ordered = sorted(samples)
+    return {
+        'count': len(ordered),
+        'mean_ms': round(statistics.mean(ordered) * 1000, 2),
+        'p50_ms': round(ordered[len(ordered) // 2] * 1000, 2),
+        'p95_ms': round(ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))] * 1000, 2),
+        'max_ms': round(ordered[-1] * 1000, 2),
+    }
+
+
+def app_script(config, history_size=0):
+    """AppTest entry point: install the fake and run app.py as Streamlit would"""
+    import os
+    import runpy
+    import sys
+
+    import streamlit as st
+
+    sys.path.insert(0, os.environ['BENCH_ROOT'])
+    import benchmark
+
+    benchmark.install_fake(benchmark.FakeConfig(**config))
+    if history_size and 'chat_history' not in st.session_state:
+        st.session_state.chat_history = [
+            {"role": "user" if i % 2 == 0 else "assistant", "content": f"Message {i} " + "text " * 60}
+            for i in range(history_size)
+        ]
+    runpy.run_path(os.environ['BENCH_APP'], run_name='__main__')
+
+
+def bench_turns(config, runs=3):
+    """End-to-end latency of each conversational turn through main()"""
+    from streamlit.testing.v1 import AppTest
+
+    samples = []
+    for _ in range(runs):
+        at = AppTest.from_function(app_script, args=(config.to_dict(),), default_timeout=120)
+        at.run()
+        if at.exception:
+            raise RuntimeError(at.exception[0].message)
+        for message in CONVERSATION:
+            start = time.perf_counter()
+            at.chat_input[0].set_value(message).run()
+            samples.append(time.perf_counter() - start)
+            if at.exception:
+                raise RuntimeError(at.exception[0].message)
+    return summarize(samples)
+
+
+def bench_throughput(app, config, concurrency, requests_per_task=20):
+    """Calls per second through RequestEngine.generate() for extraction and itinerary prompts
+
+    This measures the engine (retries, concurrency cap) with the circuit
+    breaker and rate limiter out of the way. It does not run
+    extract_preferences() or the itinerary job, so their local fast path,
+    validation and job queue are not included; bench_turns covers those.
+    """
+    preferences = app['TravelPreferences'].from_dict(CANNED_EXTRACTION)
+    tasks = {
+        'engine_extract': ('extract', lambda i: app['build_targeted_prompt'](f"message {i}", preferences, 'budget')),
+        'engine_itinerary': ('itinerary', lambda i: app['build_itinerary_prompt'](preferences) + f"\n{i}"),
+    }
+    results = {}
+    for name, (task, make_prompt) in tasks.items():
+        model = FakeGenerativeModel(system_instruction=app['SYSTEM_INSTRUCTIONS'][task])
+        engine = app['RequestEngine'](
+            app['MemoryCache'](), max_concurrent=concurrency,
+            retry_policy=app['RetryPolicy'](base_delay=0.01),
+            breaker=app['CircuitBreaker'](failure_threshold=10 ** 6),
+            limiter=app['TokenBucketLimiter'](rpm=10 ** 6, tpm=10 ** 9),
+        )
+        latencies = []
+        failures = 0
+
+        def call(i):
+            start = time.perf_counter()
+            text = engine.generate(model, make_prompt(i), use_cache=False, caller=task)
+            return time.perf_counter() - start, text is None
+
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=concurrency) as pool:
+            for latency, failed in pool.map(call, range(requests_per_task)):
+                latencies.append(latency)
+                failures += failed
+        elapsed = time.perf_counter() - start
+        results[name] = {
+            'concurrency': concurrency,
+            'requests': requests_per_task,
+            'failures': failures,
+            'throughput_rps': round(requests_per_task / elapsed, 2),
+            'latency': summarize(latencies),
+        }
+    return results
+
+
+def bench_render(config, sizes=(10, 50, 200, 1000), runs=3):
+    """Script run time as chat_history grows"""
+    from streamlit.testing.v1 import AppTest
+
+    results = {}
+    for size in sizes:
+        at = AppTest.from_function(app_script, args=(config.to_dict(), size), default_timeout=120)
+        at.run()
+        samples = []
+        for _ in range(runs):
+            start = time.perf_counter()
+            at.run()
+            samples.append(time.perf_counter() - start)
+        results[str(size)] = summarize(samples)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--latency-ms', type=float, default=300, help="Mean time to first byte")
+    parser.add_argument('--jitter-ms', type=float, default=100, help="Standard deviation of the latency")
+    parser.add_argument('--tokens-per-sec', type=float, default=200, help="Output token rate")
+    parser.add_argument('--itinerary-tokens', type=int, default=1200, help="Length of fake itineraries")
+    parser.add_argument('--error-rate', type=float, default=0.0, help="Share of calls that fail")
+    parser.add_argument('--concurrency', type=int, default=4, help="Concurrent callers for throughput")
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--output', help="Write the JSON results here instead of stdout")
+    args = parser.parse_args()
+
+    config = FakeConfig(args.latency_ms, args.jitter_ms, args.tokens_per_sec, args.itinerary_tokens,
+                        args.error_rate, args.seed)
+    # The app's debug logging goes to stderr so stdout holds only the JSON results
+    with tempfile.TemporaryDirectory() as workdir, contextlib.redirect_stdout(sys.stderr):
+        prepare_environment(workdir)
+        os.environ['BENCH_ROOT'] = ROOT
+        os.environ['BENCH_APP'] = APP_PATH
+        install_fake(config)
+        app = load_app()
+        results = {
+            'timestamp': time.time(),
+            'config': config.to_dict(),
+            'turn_latency': bench_turns(config),
+            'throughput': bench_throughput(app, config, args.concurrency),
+            'render_time': bench_render(config),
+        }
+
+    output = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+    else:
+        print(output)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
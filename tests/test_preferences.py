@@ -0,0 +1,64 @@
+"""Budget parsing and local preference extraction"""
+import os
+import runpy
+import unittest
+
+APP_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'app.py')
+
+
+def setUpModule():
+    global app
+    os.environ.setdefault('GOOGLE_API_KEY', 'test')
+    app = runpy.run_path(APP_PATH)
+
+
+class ParseBudgetTest(unittest.TestCase):
+
+    def test_level_with_budget_noun(self):
+        BudgetLevel = app['BudgetLevel']
+        self.assertEqual(app['parse_budget']("mid-range budget")[0], BudgetLevel.MID_RANGE)
+        self.assertEqual(app['parse_budget']("luxury budget")[0], BudgetLevel.LUXURY)
+        self.assertIsNone(app['parse_budget']("high budget")[0])
+        self.assertEqual(app['parse_budget']("budget")[0], BudgetLevel.BUDGET_FRIENDLY)
+
+    def test_amount_with_symbol_and_trailing_words(self):
+        self.assertEqual(app['parse_budget']("$3000 for two"), (None, 3000.0, 'USD'))
+        self.assertEqual(app['parse_budget']("$2000 total"), (None, 2000.0, 'USD'))
+        self.assertEqual(app['parse_budget']("2k eur"), (None, 2000.0, 'EUR'))
+
+    def test_currency_before_amount(self):
+        self.assertEqual(app['parse_budget']("USD 2000"), (None, 2000.0, 'USD'))
+        self.assertEqual(app['parse_budget']("rs 20000"), (None, 20000.0, 'INR'))
+
+    def test_numbers_that_are_not_amounts(self):
+        BudgetLevel = app['BudgetLevel']
+        self.assertEqual(app['parse_budget']("5-star"), (BudgetLevel.LUXURY, None, None))
+        self.assertEqual(app['parse_budget']("luxury, for 2"), (BudgetLevel.LUXURY, None, None))
+        self.assertEqual(app['parse_budget']("10-day trip, 500 eur"), (None, 500.0, 'EUR'))
+        self.assertEqual(app['parse_budget']("luxury, 3000"), (BudgetLevel.LUXURY, 3000.0, None))
+
+    def test_trailing_word_without_symbol_must_be_currency(self):
+        self.assertEqual(app['parse_budget']("3 lakhs"), (None, None, None))
+        self.assertEqual(app['parse_budget']("5 days"), (None, None, None))
+
+
+class LocalExtractionTest(unittest.TestCase):
+
+    def test_budget_keyword_needs_budget_question(self):
+        extract = app['extract_preferences_locally']
+        self.assertEqual(extract("luxury", 'budget'), ({'budget': 'luxury'}, 1.0))
+        for pending_field in ('accommodation_preferences', None):
+            prefs, confidence = extract("luxury", pending_field)
+            self.assertLess(confidence, app['LOCAL_EXTRACTION_CONFIDENCE'])
+            prefs, confidence = extract("5-star", pending_field)
+            self.assertLess(confidence, app['LOCAL_EXTRACTION_CONFIDENCE'])
+
+    def test_degraded_extraction_fills_only_missing_fields(self):
+        known = app['TravelPreferences'].from_dict({'budget': 'luxury'})
+        self.assertIsNone(app['degraded_extraction']("i have a low tolerance for heat", known))
+        self.assertIsNone(app['degraded_extraction']("cheap", known, 'budget'))
+        self.assertEqual(app['degraded_extraction']("4 days in Goa", known), {'duration': 4, 'destination': 'Goa'})
+
+
+if __name__ == "__main__":
+    unittest.main()
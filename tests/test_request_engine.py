@@ -0,0 +1,161 @@
+"""RequestEngine and CircuitBreaker behaviour against a scripted fake model
+
+Run with:
+    python -m unittest discover tests
+"""
+import os
+import runpy
+import unittest
+from types import SimpleNamespace
+
+from google.api_core import exceptions as google_exceptions
+
+APP_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'app.py')
+
+
+def setUpModule():
+    global app
+    os.environ.setdefault('GOOGLE_API_KEY', 'test')
+    app = runpy.run_path(APP_PATH)
+
+
+class ScriptedModel:
+    """Plays back a list of outcomes: exceptions are raised, strings are returned as responses"""
+
+    model_name = 'scripted'
+
+    def __init__(self, *outcomes):
+        self.outcomes = list(outcomes)
+        self.calls = 0
+
+    def next_outcome(self):
+        self.calls += 1
+        outcome = self.outcomes.pop(0)
+        if isinstance(outcome, Exception):
+            raise outcome
+        return outcome
+
+    def generate_content(self, prompt, stream=False, **kwargs):
+        text = self.next_outcome()
+        if not stream:
+            return SimpleNamespace(text=text, usage_metadata=None)
+        return iter([SimpleNamespace(text=word + ' ', usage_metadata=None) for word in text.split()])
+
+
+class HalfOpenProbeTest(unittest.TestCase):
+    """A probe that ends without a verdict must not leave the breaker stuck half-open"""
+
+    def make_engine(self):
+        breaker = app['CircuitBreaker'](failure_threshold=1, reset_timeout=0)
+        breaker.record_failure()  # Open; the next request becomes the half-open probe
+        return app['RequestEngine'](
+            app['MemoryCache'](), retry_policy=app['RetryPolicy'](base_delay=0), breaker=breaker,
+            limiter=app['TokenBucketLimiter'](rpm=10 ** 6, tpm=10 ** 9),
+        )
+
+    def assert_recovers(self, engine):
+        self.assertEqual(engine.breaker.snapshot()['state'], app['CircuitBreaker'].HALF_OPEN)
+        self.assertEqual(engine.generate(ScriptedModel('ok'), 'prompt', use_cache=False), 'ok')
+        self.assertEqual(engine.breaker.snapshot()['state'], app['CircuitBreaker'].CLOSED)
+
+    def test_fatal_error(self):
+        engine = self.make_engine()
+        model = ScriptedModel(google_exceptions.BadRequest("bad prompt"))
+        self.assertIsNone(engine.generate(model, 'prompt', use_cache=False))
+        self.assertEqual(model.calls, 1)
+        self.assert_recovers(engine)
+
+    def test_blocked_prompt(self):
+        engine = self.make_engine()
+        self.assertIsNone(engine.generate(ScriptedModel(ValueError("blocked")), 'prompt', use_cache=False))
+        self.assert_recovers(engine)
+
+    def test_expired_deadline(self):
+        engine = self.make_engine()
+        model = ScriptedModel('unused')
+        self.assertIsNone(engine.generate(model, 'prompt', use_cache=False, deadline=app['Deadline'](0)))
+        self.assertEqual(model.calls, 0)
+        self.assert_recovers(engine)
+
+    def test_abandoned_stream(self):
+        engine = self.make_engine()
+        chunks = engine.stream(ScriptedModel('a long answer'), 'prompt', use_cache=False)
+        self.assertEqual(next(chunks), 'a ')
+        chunks.close()
+        self.assert_recovers(engine)
+
+    def test_transient_error_reopens(self):
+        engine = self.make_engine()
+        engine.retry_policy.max_attempts = 1
+        model = ScriptedModel(google_exceptions.ServiceUnavailable("down"))
+        self.assertIsNone(engine.generate(model, 'prompt', use_cache=False))
+        self.assertEqual(engine.breaker.snapshot()['state'], app['CircuitBreaker'].OPEN)
+
+
+class NoTimeoutTest(unittest.TestCase):
+    """Tasks without a timeout get a Deadline that never expires"""
+
+    def make_engine(self):
+        return app['RequestEngine'](
+            app['MemoryCache'](), retry_policy=app['RetryPolicy'](base_delay=0),
+            limiter=app['TokenBucketLimiter'](rpm=10 ** 6, tpm=10 ** 9),
+        )
+
+    def test_generate_with_fallback_and_retry(self):
+        engine = self.make_engine()
+        model = ScriptedModel(google_exceptions.ServiceUnavailable("down"), 'ok')
+        deadline = app['task_deadline']('other')
+        self.assertIsNone(deadline.remaining())
+        self.assertEqual(engine.generate(model, 'prompt', use_cache=False, fallback=ScriptedModel(),
+                                         deadline=deadline), 'ok')
+        self.assertEqual(model.calls, 2)
+        self.assertEqual(engine.breaker.snapshot()['failures'], 0)
+
+    def test_stream(self):
+        engine = self.make_engine()
+        chunks = engine.stream(ScriptedModel('a b'), 'prompt', use_cache=False, fallback=ScriptedModel(),
+                               deadline=app['task_deadline']('other'))
+        self.assertEqual(''.join(chunks), 'a b ')
+
+
+class InterruptedStreamModel(ScriptedModel):
+    """Streams one chunk, then fails with an upstream timeout"""
+
+    def generate_content(self, prompt, stream=False, **kwargs):
+        self.calls += 1
+        self.request_options = kwargs.get('request_options')
+        yield SimpleNamespace(text='partial ', usage_metadata=None)
+        raise google_exceptions.DeadlineExceeded("upstream timeout")
+
+
+class StreamTest(unittest.TestCase):
+
+    def make_engine(self):
+        return app['RequestEngine'](
+            app['MemoryCache'](), retry_policy=app['RetryPolicy'](base_delay=0),
+            limiter=app['TokenBucketLimiter'](rpm=10 ** 6, tpm=10 ** 9),
+        )
+
+    def test_interrupted_stream_raises(self):
+        engine = self.make_engine()
+        model = InterruptedStreamModel()
+        chunks = []
+        with self.assertRaises(app['StreamInterrupted']):
+            for chunk in engine.stream(model, 'prompt', use_cache=False, fallback=ScriptedModel(),
+                                       deadline=app['Deadline'](60)):
+                chunks.append(chunk)
+        self.assertEqual(chunks, ['partial '])
+        self.assertEqual(model.calls, 1)
+        self.assertIsNone(engine.cache.get(app['make_cache_key']('scripted', 'prompt', None, 'other')))
+
+    def test_stream_keeps_whole_budget(self):
+        engine = self.make_engine()
+        model = InterruptedStreamModel()
+        with self.assertRaises(app['StreamInterrupted']):
+            list(engine.stream(model, 'prompt', use_cache=False, fallback=ScriptedModel(),
+                               deadline=app['Deadline'](60)))
+        self.assertGreater(model.request_options['timeout'], 59)
+
+
+if __name__ == "__main__":
+    unittest.main()